@@ -0,0 +1,260 @@
+"""Benchmarks for the post-processing of generated images and for the NovelAI session, against a local stub server.
+They run without a Discord connection or NovelAI account.
+Usage: python -m novelai.benchmark [images|session] [--images N] [--seed N] [--requests N] [--login-delay MS]"""
+
+import io
+import json
+import time
+import base64
+import random
+import asyncio
+import zipfile
+import argparse
+import statistics
+from hashlib import md5
+from contextlib import asynccontextmanager
+from typing import List, Tuple, Callable, Awaitable, Optional, AsyncIterator
+from PIL import Image, PngImagePlugin
+from aiohttp import web, ClientSession
+from novelai_api import NovelAIError, _low_level
+from novelai_api.ImagePreset import ImagePreset, ImageModel
+
+from novelai.naiapi import NaiAPI
+from novelai.pngtext import process_generated_image
+
+# portrait, landscape and square at increasing amounts of detail
+RESOLUTIONS = [(832, 1216, 0.2), (1216, 832, 0.5), (1024, 1024, 1.0)]
+PERCENTILES = (50, 90, 99)
+STUB_USERNAME, STUB_PASSWORD = "benchmark@example.com", "benchmark"
+
+
+def generate_image(width: int, height: int, noise: float, rng: random.Random) -> bytes:
+    """A PNG with the text chunks of a NovelAI image, whose size depends on how much noise it has"""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    channels = [gradient.rotate(angle, expand=False) for angle in (0, 90, 180)]
+    image = Image.merge("RGB", channels)
+    if noise:
+        noisy = Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+        image = Image.blend(image, noisy, noise)
+    image = image.convert("RGBA")
+    comment = {
+        "prompt": "1girl, best quality, amazing quality, very aesthetic, absurdres",
+        "steps": 28, "height": height, "width": width, "scale": 5.0, "uncond_scale": 1.0, "cfg_rescale": 0.0,
+        "seed": rng.randrange(2**32), "n_samples": 1, "noise_schedule": "native", "sampler": "k_euler_ancestral",
+        "signed_hash": base64.b64encode(rng.randbytes(64)).decode(),
+        "uc": "lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits",
+    }
+    pnginfo = PngImagePlugin.PngInfo()
+    pnginfo.add_text("Title", "AI generated image")
+    pnginfo.add_text("Description", comment["prompt"])
+    pnginfo.add_text("Software", "NovelAI")
+    pnginfo.add_text("Source", "Stable Diffusion XL C1E1DE52")
+    pnginfo.add_text("Generation time", "4.5")
+    pnginfo.add_text("Comment", json.dumps(comment))
+    fp = io.BytesIO()
+    image.save(fp, "png", pnginfo=pnginfo)
+    return fp.getvalue()
+
+
+def reencode_image(image_bytes: bytes) -> Tuple[bytes, dict, str]:
+    """How images were processed before, decoding and encoding them again with Pillow"""
+    image = Image.open(io.BytesIO(image_bytes))
+    comment = json.loads(image.info["Comment"])
+    del comment["signed_hash"]
+    image.info["Comment"] = json.dumps(comment)
+    pnginfo = PngImagePlugin.PngInfo()
+    for key, val in image.info.items():
+        pnginfo.add_text(str(key), str(val))
+    fp = io.BytesIO()
+    image.save(fp, "png", pnginfo=pnginfo)
+    fp.seek(0)
+    image_bytes = fp.read()
+    return image_bytes, image.info, md5(image_bytes).hexdigest() + ".png"
+
+
+def percentiles(samples: List[float]) -> str:
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return ", ".join(f"p{p} {cuts[p - 1] * 1000:.1f} ms" for p in PERCENTILES)
+
+
+async def measure(process: Callable[[bytes], Awaitable], images: List[bytes]) -> Tuple[List[float], float]:
+    """Latency of processing each image, and the longest the event loop was blocked meanwhile"""
+    stall = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal stall
+        while running:
+            before = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stall = max(stall, time.perf_counter() - before - 0.001)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    latencies = []
+    for image_bytes in images:
+        start = time.perf_counter()
+        await process(image_bytes)
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0.005)  # the bot does other things between images
+    running = False
+    await task
+    return latencies, stall
+
+
+async def run(images: List[bytes]):
+    async def before(image_bytes: bytes):
+        return reencode_image(image_bytes)
+
+    async def after(image_bytes: bytes):
+        return await asyncio.to_thread(process_generated_image, image_bytes)
+
+    old, new = reencode_image(images[0]), process_generated_image(images[0])
+    assert json.loads(old[1]["Comment"]) == json.loads(new[1]["Comment"])
+    assert Image.open(io.BytesIO(old[0])).tobytes() == Image.open(io.BytesIO(new[0])).tobytes()
+
+    for label, process in (("re-encode on the event loop", before), ("chunk rewrite in a thread", after)):
+        latencies, stall = await measure(process, images)
+        print(f"{label}: {percentiles(latencies)}, longest event loop stall {stall * 1000:.1f} ms")
+
+
+class StubServer:
+    """Local stand-in for the NovelAI login and image generation endpoints, which counts the logins.
+    Generations are rejected with a 401 unless they use the last access token given out."""
+
+    def __init__(self, image: bytes, login_delay: float):
+        self.login_delay = login_delay
+        self.logins = 0
+        self.token = ""
+        fp = io.BytesIO()
+        with zipfile.ZipFile(fp, "w") as archive:
+            archive.writestr("image_0.png", image)
+        self.archive = fp.getvalue()
+
+    async def login(self, _: web.Request) -> web.Response:
+        await asyncio.sleep(self.login_delay)
+        self.logins += 1
+        # a JWT that expires in an hour, different for every login
+        payload = base64.urlsafe_b64encode(json.dumps({"exp": int(time.time()) + 3600, "n": self.logins}).encode())
+        self.token = "e30." + payload.decode().rstrip("=") + ".stub"
+        return web.json_response({"accessToken": self.token}, status=201)
+
+    async def generate(self, request: web.Request) -> web.Response:
+        if request.headers.get("Authorization") != f"Bearer {self.token}":
+            return web.json_response({"statusCode": 401, "message": "Invalid access token"}, status=401)
+        return web.Response(body=self.archive, content_type="application/x-zip-compressed")
+
+    def revoke(self):
+        self.token = ""
+
+    @asynccontextmanager
+    async def serve(self) -> AsyncIterator[str]:
+        """Runs the server on a free local port and points the NovelAI API at it, yielding its address"""
+        app = web.Application()
+        app.router.add_post("/user/login", self.login)
+        app.router.add_post("/ai/generate-image", self.generate)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        address = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        image_address = _low_level.IMAGE_API_ADDRESS
+        _low_level.IMAGE_API_ADDRESS = address  # read by the library on every generation
+        try:
+            yield address
+        finally:
+            _low_level.IMAGE_API_ADDRESS = image_address
+            await runner.cleanup()
+
+
+def stub_preset() -> ImagePreset:
+    preset = ImagePreset.from_default_config(ImageModel.Anime_v3)
+    preset.n_samples = 1
+    preset.resolution = (64, 64)
+    return preset
+
+
+def stub_api(address: str) -> NaiAPI:
+    api = NaiAPI(STUB_USERNAME, STUB_PASSWORD)
+    api.api.BASE_ADDRESS = address
+    return api
+
+
+async def generate_with(api: NaiAPI) -> bytes:
+    """One generation the way the cog requests it, logging in again once if the access token was rejected"""
+    for retry in range(2):
+        try:
+            async with api as wrapper:
+                async for _, image in wrapper.api.high_level.generate_image("1girl", ImageModel.Anime_v3, stub_preset()):
+                    return image
+        except NovelAIError as error:
+            if error.status != 401 or retry:
+                raise
+            api.expire()
+
+
+async def generate_with_fresh_login(address: str) -> bytes:
+    """One generation the way it was done before, with a new session and login for every request"""
+    api = stub_api(address)
+    async with ClientSession() as session:
+        api.api.attach_session(session)
+        await api.api.high_level.login(STUB_USERNAME, STUB_PASSWORD)
+        async for _, image in api.api.high_level.generate_image("1girl", ImageModel.Anime_v3, stub_preset()):
+            return image
+
+
+async def measure_generations(stub: StubServer, generate: Callable[[], Awaitable[bytes]], requests: int) -> List[float]:
+    """Latency of each generation, with the stub counting the logins from zero"""
+    stub.logins = 0
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        await generate()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def run_session(image: bytes, requests: int, login_delay: float):
+    stub = StubServer(image, login_delay)
+    async with stub.serve() as address:
+        latencies = await measure_generations(stub, lambda: generate_with_fresh_login(address), requests)
+        print(f"fresh session and login per request: {percentiles(latencies)}, {stub.logins} logins")
+
+        api = stub_api(address)
+        latencies = await measure_generations(stub, lambda: generate_with(api), requests)
+        print(f"persistent session and token: {percentiles(latencies)}, {stub.logins} logins")
+        stub.revoke()
+        await measure_generations(stub, lambda: generate_with(api), 1)
+        print(f"after the access token was revoked: {stub.logins} logins")
+        await api.close()
+
+        api = stub_api(address)
+        stub.logins = 0
+        await asyncio.gather(*(generate_with(api) for _ in range(5)))
+        print(f"5 concurrent generations on a new session: {stub.logins} logins")
+        await api.close()
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("mode", nargs="?", choices=("images", "session"), default="images")
+    parser.add_argument("--images", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--requests", type=int, default=20, help="generations in session mode")
+    parser.add_argument("--login-delay", type=float, default=50, help="milliseconds the stub takes to log in")
+    options = parser.parse_args(args)
+    rng = random.Random(options.seed)
+    if options.mode == "session":
+        print(f"Generating {options.requests} images from a local stub that takes {options.login_delay:g} ms to log in")
+        asyncio.run(run_session(generate_image(64, 64, 1.0, rng), options.requests, options.login_delay / 1000))
+        return
+    samples = [generate_image(*resolution, rng) for resolution in RESOLUTIONS]
+    sizes = ", ".join(f"{width}x{height} {len(sample) / 1024 / 1024:.1f} MB"
+                      for (width, height, _), sample in zip(RESOLUTIONS, samples))
+    print(f"Post-processing {options.images} images ({sizes})")
+    images = [samples[i % len(samples)] for i in range(options.images)]
+    asyncio.run(run(images))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,19 @@ from collections import OrderedDict
 
 VIEW_TIMEOUT = 5 * 60
 
+TOKEN_LIFETIME = 24 * 60 * 60  # seconds, used when the access token doesn't say when it expires
+TOKEN_EXPIRY_MARGIN = 5 * 60  # seconds before expiry when the token gets renewed
+
+MAX_CONCURRENCY = 10
+CONCURRENCY_PROBE_STREAK = 10  # successes per running generation before trying one more at the same time
+RATE_LIMIT_BACKOFF = 30  # seconds after a rate limit during which further ones don't lower the concurrency again
+QUEUE_EDIT_DEBOUNCE = 1  # seconds to gather queue changes before editing positions
+QUEUE_EDIT_INTERVAL = 5  # seconds between edits of the same message
+IMAGE_CACHE_SIZE = 64 * 1024 * 1024  # bytes of base64 images kept to be reused
+RESULT_CACHE_SIZE = 512 * 1024 * 1024  # bytes of generated images kept on disk for requests with a seed
+RESULT_CACHE_DIR = "results"
+USER_SETTINGS_CACHE_SIZE = 1000  # users whose settings are kept in memory
+
 MAX_FREE_IMAGE_SIZE = 1024*1024
 MAX_UPLOADED_IMAGE_SIZE = 1920*1080
 
@@ -0,0 +1,55 @@
+import io
+import base64
+import asyncio
+import discord
+from hashlib import md5
+from collections import OrderedDict
+from typing import Tuple, Optional
+from PIL import Image
+
+from novelai.constants import IMAGE_CACHE_SIZE
+
+Key = Tuple[str, Optional[Tuple[int, int]]]
+
+
+def encode_image(data: bytes, size: Optional[Tuple[int, int]] = None) -> str:
+    """Base64 payload of an image, resized first if a size is given"""
+    if size:
+        image = Image.open(io.BytesIO(data)).resize(size, Image.Resampling.LANCZOS)
+        fp = io.BytesIO()
+        image.save(fp, "PNG")
+        data = fp.getvalue()
+    return base64.b64encode(data).decode()
+
+
+class ImageCache:
+    """Base64 payloads of the images sent by users, keyed by their content.
+    An image used for many generations is only encoded once, and every preset using it shares the same string.
+    The least recently used payloads are dropped to stay within a byte budget."""
+
+    def __init__(self, budget: int = IMAGE_CACHE_SIZE):
+        self.budget = budget
+        self.size = 0
+        self.entries: OrderedDict[Key, str] = OrderedDict()
+
+    async def get(self, attachment: discord.Attachment, size: Optional[Tuple[int, int]] = None) -> str:
+        """Base64 payload of the attachment, resized first if a size is given"""
+        data = await attachment.read()
+        key = (await asyncio.to_thread(lambda: md5(data).hexdigest()), size)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        payload = await asyncio.to_thread(encode_image, data, size)
+        self.put(key, payload)
+        return payload
+
+    def put(self, key: Key, payload: str):
+        if len(payload) > self.budget:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = payload
+        self.size += len(payload)
+        while self.size > self.budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
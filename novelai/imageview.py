@@ -50,8 +50,7 @@ class ImageView(View):
         await ctx.message.edit(view=self)
         btn.disabled = False  # re-enables it after the task calls back
 
-        content = self.cog.get_loading_message()
-        self.cog.queue_add(ctx, self.prompt, self.preset, self.model, ctx.user.id, self.message_edit_callback(ctx))
+        content = await self.cog.queue_add(ctx, self.prompt, self.preset, self.model, ctx.user.id, self.message_edit_callback(ctx))
         await ctx.response.send_message(content=content)
 
     @discord.ui.button(emoji="🗑️", style=discord.ButtonStyle.grey)
@@ -100,8 +99,7 @@ class RetryView(View):
         self.deleted = True
         self.stop()
         await ctx.message.edit(view=None)
-        content = self.cog.get_loading_message()
-        self.cog.queue_add(ctx, self.prompt, self.preset, self.model, ctx.user.id, ctx.message.edit(view=None))
+        content = await self.cog.queue_add(ctx, self.prompt, self.preset, self.model, ctx.user.id, ctx.message.edit(view=None))
         await ctx.response.send_message(content=content)
 
     async def on_timeout(self) -> None:
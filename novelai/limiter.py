@@ -0,0 +1,71 @@
+import time
+import asyncio
+
+from novelai.constants import CONCURRENCY_PROBE_STREAK, RATE_LIMIT_BACKOFF
+
+
+class AdaptiveLimiter:
+    """Limits how many generations run at the same time.
+    The limit halves when NovelAI rate limits the account, and grows back by one after a streak of successes,
+    up to the configured maximum."""
+
+    def __init__(self, maximum: int):
+        self.maximum = maximum
+        self.limit = maximum
+        self.running = 0
+        self.streak = 0
+        self.last_rate_limit = 0.0
+        self._freed = asyncio.Event()
+
+    @property
+    def full(self) -> bool:
+        return self.running >= self.limit
+
+    async def acquire(self):
+        while self.full:
+            self._freed.clear()
+            await self._freed.wait()
+        self.running += 1
+
+    def release(self):
+        self.running -= 1
+        self._freed.set()
+
+    def set_maximum(self, maximum: int):
+        self.maximum = maximum
+        self.limit = maximum
+        self.streak = 0
+        self._freed.set()
+
+    def rate_limited(self):
+        now = time.monotonic()
+        if now - self.last_rate_limit < RATE_LIMIT_BACKOFF:  # the same burst of requests
+            return
+        self.last_rate_limit = now
+        self.limit = max(1, self.limit // 2)
+        self.streak = 0
+
+    def succeeded(self):
+        self.streak += 1
+        if self.limit < self.maximum and self.streak >= CONCURRENCY_PROBE_STREAK * self.limit:
+            self.limit += 1
+            self.streak = 0
+            self._freed.set()
+
+
+class Slot:
+    """A job's place in the limiter, which it may give up while it waits and take back.
+    Whoever finishes the job releases it only if it's still held, so the count of running jobs stays right."""
+
+    def __init__(self, limiter: AdaptiveLimiter):
+        self.limiter = limiter
+        self.held = False
+
+    async def acquire(self):
+        await self.limiter.acquire()
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.limiter.release()
@@ -1,20 +1,39 @@
 # https://github.com/Aedial/novelai-api/blob/main/example/boilerplate.py
 
 import json
+import time
+import base64
+import asyncio
 from logging import Logger, StreamHandler
 from typing import Optional
 from aiohttp import ClientSession
 from novelai_api import NovelAIAPI
-from novelai_api.utils import get_encryption_key
+from novelai_api.utils import get_encryption_key, get_access_key
+
+from novelai.constants import TOKEN_LIFETIME, TOKEN_EXPIRY_MARGIN
+
+
+def token_expiry(access_token: str) -> float:
+    """Reads the expiration time from the access token, which is a JWT, or guesses it if it can't"""
+    try:
+        payload = access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + TOKEN_LIFETIME
 
 
 class NaiAPI:
-    """Boilerplate for the NovelAIAPI"""
+    """Boilerplate for the NovelAIAPI.
+    Keeps a single session and access token for as long as the cog is loaded, logging in again only when the token expires."""
 
     def __init__(self, username: str, password: str):
         self._username = username
         self._password = password
         self._session: Optional[ClientSession] = None
+        self._access_key: Optional[str] = None
+        self._expiry = 0.0
+        self._lock = asyncio.Lock()
         self.logger = Logger("NovelAI")
         self.logger.addHandler(StreamHandler())
         self.api = NovelAIAPI(logger=self.logger)
@@ -23,14 +42,37 @@ class NaiAPI:
     def encryption_key(self):
         return get_encryption_key(self._username, self._password)
 
-    async def __aenter__(self):
-        self._session = ClientSession()
-        await self._session.__aenter__()
-
-        self.api.attach_session(self._session)
-        await self.api.high_level.login(self._username, self._password)
+    @property
+    def logged_in(self) -> bool:
+        return self._session is not None and not self._session.closed \
+            and time.time() < self._expiry - TOKEN_EXPIRY_MARGIN
 
+    async def __aenter__(self):
+        if not self.logged_in:
+            await self.login()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._session.__aexit__(exc_type, exc_val, exc_tb)
+        pass  # the session stays open until close()
+
+    async def login(self):
+        async with self._lock:
+            if self.logged_in:  # another request got here first
+                return
+            if self._session is None or self._session.closed:
+                self._session = ClientSession()
+                self.api.attach_session(self._session)
+            if not self._access_key:  # argon2 is slow, keep it off the event loop
+                self._access_key = await asyncio.to_thread(get_access_key, self._username, self._password)
+            access_token = await self.api.high_level.login_from_key(self._access_key)
+            self._expiry = token_expiry(access_token)
+
+    def expire(self):
+        """Makes the next request log in again, after the access token was rejected"""
+        self._expiry = 0.0
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._expiry = 0.0
@@ -1,21 +1,27 @@
 import io
 import re
 import json
-import base64
 import asyncio
 import discord
 import logging
-from hashlib import md5
 from datetime import datetime, timedelta
-from typing import Optional, Tuple, Coroutine, Dict, List
-from PIL import Image, PngImagePlugin
+from collections import OrderedDict
+from typing import Optional, Tuple, Coroutine, Dict
+from PIL import Image
 from redbot.core import commands, app_commands, Config
 from redbot.core.bot import Red
+from redbot.core.data_manager import cog_data_path
 from novelai_api import NovelAIError
 from novelai_api.ImagePreset import ImageModel, ImagePreset, ImageSampler, ImageGenerationType, UCPreset
 
 import novelai.constants as const
 from novelai.naiapi import NaiAPI
+from novelai.limiter import AdaptiveLimiter, Slot
+from novelai.scheduler import FairScheduler
+from novelai.positions import PositionUpdater
+from novelai.pngtext import process_generated_image
+from novelai.imagecache import ImageCache
+from novelai.resultcache import ResultCache, result_key
 from novelai.imageview import ImageView, RetryView
 
 log = logging.getLogger("red.crab-cogs.novelai")
@@ -35,10 +41,15 @@ class NovelAI(commands.Cog):
         super().__init__()
         self.bot = bot
         self.api: Optional[NaiAPI] = None
-        self.queue: List[Tuple[Coroutine, discord.Interaction]] = []
+        self.queue: FairScheduler[Tuple[Coroutine, Slot, discord.Interaction, bool]] = FairScheduler()
         self.queue_task: Optional[asyncio.Task] = None
+        self.limiter = AdaptiveLimiter(1)
+        self.positions = PositionUpdater(self)
+        self.image_cache = ImageCache()
+        self.result_cache = ResultCache(cog_data_path(self).joinpath(const.RESULT_CACHE_DIR))
         self.generating: Dict[int, bool] = {}
         self.user_last_img: Dict[int, datetime] = {}
+        self.user_settings: OrderedDict[int, dict] = OrderedDict()  # of the most recent users
         self.last_generation_datetime: datetime = datetime.min
         self.loading_emoji = ""
         self.config = Config.get_conf(self, identifier=66766566169)
@@ -66,36 +77,69 @@ class NovelAI(commands.Cog):
             "dm_allowed": True,
             "loading_emoji": "",
             "vip": [],
+            "concurrency": 1,
         }
         defaults_guild = {
             "nsfw_filter": False,
+            "queue_weight": 1.0,
         }
         self.config.register_user(**defaults_user)
         self.config.register_global(**defaults_global)
-        self.config.register_global(**defaults_guild)
+        self.config.register_guild(**defaults_guild)
 
     async def cog_load(self):
         await self.try_create_api()
         self.loading_emoji = await self.config.loading_emoji()
+        self.limiter.set_maximum(await self.config.concurrency())
+        self.positions.start()
+        await self.result_cache.load()
+
+    async def cog_unload(self):
+        self.positions.stop()
+        if self.api:
+            await self.api.close()
 
     async def red_delete_data_for_user(self, requester: str, user_id: int):
         await self.config.user_from_id(user_id).clear()
+        self.user_settings.pop(user_id, None)
+
+    async def get_user_settings(self, user: discord.abc.User) -> dict:
+        """All of a user's settings, read from the config only the first time while they're recent. Not to be modified."""
+        settings = self.user_settings.get(user.id)
+        if settings is None:
+            settings = await self.config.user(user).all()
+            self.user_settings[user.id] = settings
+            while len(self.user_settings) > const.USER_SETTINGS_CACHE_SIZE:
+                self.user_settings.popitem(last=False)
+        self.user_settings.move_to_end(user.id)
+        return settings
 
     async def try_create_api(self):
         api = await self.bot.get_shared_api_tokens("novelai")
         username, password = api.get("username"), api.get("password")
         if username and password:
+            if self.api:
+                await self.api.close()
             self.api = NaiAPI(username, password)
             return True
         else:
             return False
 
     async def consume_queue(self):
-        new = True
         while self.queue:
-            task, ctx = self.queue.pop(0)
-            alive = True
-            if not new:
+            await self.limiter.acquire()
+            generation_cooldown = await self.config.generation_cooldown()
+            while (seconds := (datetime.now() - self.last_generation_datetime).total_seconds()) < generation_cooldown:
+                log.debug(f"Waiting on generation_cooldown... {seconds} seconds remaining.")
+                await asyncio.sleep(1)
+            self.last_generation_datetime = datetime.now()
+            task, slot, ctx, waited = self.queue.pop()
+            slot.held = True  # the job now owns the place acquired above
+            await self.positions.forget(ctx)
+            alive = not ctx.is_expired()  # the result couldn't be shown anymore
+            if not alive:
+                self.generating[ctx.user.id] = False
+            elif waited:  # otherwise it already says it's generating
                 try:
                     await ctx.edit_original_response(content=self.loading_emoji + "`Generating image...`")
                 except discord.errors.NotFound:
@@ -104,32 +148,60 @@ class NovelAI(commands.Cog):
                 except Exception:  # noqa, reason: low importance, should fail silently
                     log.exception("Editing message in queue")
             if self.queue:
-                _ = asyncio.create_task(self.edit_queue_messages())
+                self.positions.notify()
             if alive:
-                await task
-            await asyncio.sleep(2)
-            new = False
-
-    async def edit_queue_messages(self):
-        tasks = [ctx.edit_original_response(content=self.loading_emoji + f"`Position in queue: {i + 1}`")
-                 for i, (task, ctx) in enumerate(self.queue)]
-        await asyncio.gather(*tasks, return_exceptions=True)
-
-    def queue_add(self,
-                  ctx: discord.Interaction,
-                  prompt: str,
-                  preset: ImagePreset,
-                  model: ImageModel,
-                  requester: Optional[int] = None,
-                  callback: Optional[Coroutine] = None):
+                _ = asyncio.create_task(self.run_worker(task, slot))
+            else:
+                task.close()
+                slot.release()
+
+    @staticmethod
+    async def run_worker(task: Coroutine, slot: Slot):
+        try:
+            await task
+        finally:
+            slot.release()
+
+    async def queue_add(self,
+                        ctx: discord.Interaction,
+                        prompt: str,
+                        preset: ImagePreset,
+                        model: ImageModel,
+                        requester: Optional[int] = None,
+                        callback: Optional[Coroutine] = None) -> str:
+        """Adds a generation to the queue and returns the loading message to show for it"""
         self.generating[ctx.user.id] = True
-        self.queue.append((self.fulfill_novelai_request(ctx, prompt, preset, model, requester, callback), ctx))
+        waiting = self.is_queue_busy()
+        weight = await self.config.guild(ctx.guild).queue_weight() if ctx.guild else 1.0
+        vip = ctx.user.id in await self.config.vip()
+        cache_key = await asyncio.to_thread(result_key, prompt, preset, model) if preset.seed else None
+        cached = await self.result_cache.get(cache_key)  # read now, as it could be evicted while waiting
+        slot = Slot(self.limiter)
+        task = self.fulfill_novelai_request(ctx, prompt, preset, model, requester, callback, cache_key, cached, slot)
+        if cached is not None:  # generated before, it doesn't need to wait
+            _ = asyncio.create_task(self.run_cached(ctx, task))
+            return self.loading_emoji + "`Generating image...`"
+        key = self.queue.push((task, slot, ctx, waiting), ctx.user.id, weight, vip)
         if not self.queue_task or self.queue_task.done():
             self.queue_task = asyncio.create_task(self.consume_queue())
-
-    def get_loading_message(self):
-        message = f"`Position in queue: {len(self.queue) + 1}`" if self.queue_task and not self.queue_task.done() else "`Generating image...`"
-        return self.loading_emoji + message
+        if not waiting:
+            return self.loading_emoji + "`Generating image...`"
+        position = self.queue.position(key)
+        self.positions.shown_position(ctx, position)
+        if position < len(self.queue):  # it went ahead of others
+            self.positions.notify()
+        return self.loading_emoji + f"`Position in queue: {position}`"
+
+    @staticmethod
+    async def run_cached(ctx: discord.Interaction, task: Coroutine):
+        for _ in range(50):  # the response is only sent after queue_add returns
+            if ctx.response.is_done():
+                break
+            await asyncio.sleep(0.1)
+        await task
+
+    def is_queue_busy(self) -> bool:
+        return bool(self.queue) or self.limiter.full
 
     @app_commands.command(name="novelai",
                           description="Generate anime images with NovelAI v3.")
@@ -173,10 +245,11 @@ class NovelAI(commands.Cog):
             if "image" not in reference_image3.content_type or not reference_image3.width or not reference_image3.height or not (reference_image3.size / 1024 / 1024) <= max_image_size:
                 return await ctx.response.send_message(f"reference_image3 must be a valid image and less than {max_image_size} MB.", ephemeral=True)
                       
-        model = model or ImageModel(await self.config.user(ctx.user).model())
+        settings = await self.get_user_settings(ctx.user)
+        model = model or ImageModel(settings["model"])
                       
         result = await self.prepare_novelai_request(
-            ctx, prompt, negative_prompt, seed, resolution, guidance, guidance_rescale,
+            ctx, settings, prompt, negative_prompt, seed, resolution, guidance, guidance_rescale,
             sampler, sampler_version, noise_schedule, decrisper, model
         )
         if not result:
@@ -187,28 +260,27 @@ class NovelAI(commands.Cog):
             reference_images = []
             reference_strengths = []
             reference_infos = []
-            default_strength = await self.config.user(ctx.user).reference_image_strength() or 0.6
-            default_info = await self.config.user(ctx.user).reference_image_info_extracted() or 1.0
+            default_strength = settings["reference_image_strength"] or 0.6
+            default_info = settings["reference_image_info_extracted"] or 1.0
             if reference_image1:
-                reference_images.append(base64.b64encode(await reference_image1.read()).decode())
+                reference_images.append(await self.image_cache.get(reference_image1))
                 reference_strengths.append(reference_image_strength1 or default_strength)
                 reference_infos.append(reference_image_info_extracted1 or default_info)
             
             if reference_image2:
-                reference_images.append(base64.b64encode(await reference_image2.read()).decode())
+                reference_images.append(await self.image_cache.get(reference_image2))
                 reference_strengths.append(reference_image_strength2 or default_strength)
                 reference_infos.append(reference_image_info_extracted2 or default_info)
                 
             if reference_image3:
-                reference_images.append(base64.b64encode(await reference_image3.read()).decode())
+                reference_images.append(await self.image_cache.get(reference_image3))
                 reference_strengths.append(reference_image_strength3 or default_strength)
                 reference_infos.append(reference_image_info_extracted3 or default_info)
             preset.reference_image_multiple = reference_images
             preset.reference_strength_multiple = reference_strengths
             preset.reference_information_extracted_multiple = reference_infos
 
-        message = self.get_loading_message()
-        self.queue_add(ctx, prompt, preset, model)
+        message = await self.queue_add(ctx, prompt, preset, model)
         await ctx.response.send_message(content=message)
 
     @app_commands.command(name="novelai-img2img",
@@ -263,10 +335,11 @@ class NovelAI(commands.Cog):
         width, height = scale_to_size(image.width, image.height, const.MAX_FREE_IMAGE_SIZE)
         resolution = f"{round_to_nearest(width, 64)},{round_to_nearest(height, 64)}"
         
-        model = model or ImageModel(await self.config.user(ctx.user).model())
+        settings = await self.get_user_settings(ctx.user)
+        model = model or ImageModel(settings["model"])
 
         result = await self.prepare_novelai_request(
-            ctx, prompt, negative_prompt, seed, resolution, guidance, guidance_rescale,
+            ctx, settings, prompt, negative_prompt, seed, resolution, guidance, guidance_rescale,
             sampler, sampler_version, noise_schedule, decrisper, model
         )
         if not result:
@@ -276,50 +349,45 @@ class NovelAI(commands.Cog):
         prompt, preset = result
         preset.strength = strength
         preset.noise = noise
-        fp = io.BytesIO()
-        await image.save(fp)
+        size = None
         if image.width*image.height > const.MAX_UPLOADED_IMAGE_SIZE:
-            try:
-                width, height = scale_to_size(image.width, image.height, const.MAX_UPLOADED_IMAGE_SIZE)
-                resized_image = Image.open(fp).resize((width, height), Image.Resampling.LANCZOS)
-                fp = io.BytesIO()
-                resized_image.save(fp, "PNG")
-                fp.seek(0)
-            except Image.UnidentifiedImageError:
-                log.exception("Resizing image")
-                return await ctx.followup.send(":warning: Failed to resize image. Please try sending a smaller image.")
-        preset.image = base64.b64encode(fp.read()).decode()
+            size = scale_to_size(image.width, image.height, const.MAX_UPLOADED_IMAGE_SIZE)
+        try:
+            preset.image = await self.image_cache.get(image, size)
+        except Image.UnidentifiedImageError:
+            log.exception("Resizing image")
+            return await ctx.followup.send(":warning: Failed to resize image. Please try sending a smaller image.")
         
         if reference_image1 or reference_image2 or reference_image3:
             reference_images = []
             reference_strengths = []
             reference_infos = []
-            default_strength = await self.config.user(ctx.user).reference_image_strength() or 0.6
-            default_info = await self.config.user(ctx.user).reference_image_info_extracted() or 1.0
+            default_strength = settings["reference_image_strength"] or 0.6
+            default_info = settings["reference_image_info_extracted"] or 1.0
             if reference_image1:
-                reference_images.append(base64.b64encode(await reference_image1.read()).decode())
+                reference_images.append(await self.image_cache.get(reference_image1))
                 reference_strengths.append(reference_image_strength1 or default_strength)
                 reference_infos.append(reference_image_info_extracted1 or default_info)
             
             if reference_image2:
-                reference_images.append(base64.b64encode(await reference_image2.read()).decode())
+                reference_images.append(await self.image_cache.get(reference_image2))
                 reference_strengths.append(reference_image_strength2 or default_strength)
                 reference_infos.append(reference_image_info_extracted2 or default_info)
                 
             if reference_image3:
-                reference_images.append(base64.b64encode(await reference_image3.read()).decode())
+                reference_images.append(await self.image_cache.get(reference_image3))
                 reference_strengths.append(reference_image_strength3 or default_strength)
                 reference_infos.append(reference_image_info_extracted3 or default_info)
             preset.reference_image_multiple = reference_images
             preset.reference_strength_multiple = reference_strengths
             preset.reference_information_extracted_multiple = reference_infos
 
-        message = self.get_loading_message()
-        self.queue_add(ctx, prompt, preset, model)
+        message = await self.queue_add(ctx, prompt, preset, model)
         await ctx.edit_original_response(content=message)
 
     async def prepare_novelai_request(self,
                                       ctx: discord.Interaction,
+                                      settings: dict,
                                       prompt: str,
                                       negative_prompt: Optional[str],
                                       seed: Optional[int],
@@ -353,18 +421,18 @@ class NovelAI(commands.Cog):
                 return await ctx.response.send_message(content, ephemeral=True)
 
         if model == ImageModel.Furry_v3:
-            base_prompt = await self.config.user(ctx.user).base_furry_prompt()
-            base_neg = await self.config.user(ctx.user).base_furry_negative_prompt()
+            base_prompt = settings["base_furry_prompt"]
+            base_neg = settings["base_furry_negative_prompt"]
         else:
-            base_prompt = await self.config.user(ctx.user).base_prompt()
-            base_neg = await self.config.user(ctx.user).base_negative_prompt()
+            base_prompt = settings["base_prompt"]
+            base_neg = settings["base_negative_prompt"]
 
         if base_prompt:
             prompt = f"{prompt.strip(' ,')}, {base_prompt}" if prompt else base_prompt
         if base_neg:
             negative_prompt = f"{negative_prompt.strip(' ,')}, {base_neg}" if negative_prompt else base_neg
         
-        resolution = resolution or await self.config.user(ctx.user).resolution()
+        resolution = resolution or settings["resolution"]
 
         if ctx.guild and not ctx.channel.nsfw and const.NSFW_TERMS.search(prompt):
             return await ctx.response.send_message(":warning: You may not generate NSFW images in non-NSFW channels.")
@@ -397,11 +465,11 @@ class NovelAI(commands.Cog):
         
         preset.uc_preset = UCPreset.Preset_None
         preset.quality_toggle = False
-        preset.sampler = sampler or ImageSampler(await self.config.user(ctx.user).sampler())
-        preset.scale = guidance if guidance is not None else await self.config.user(ctx.user).guidance()
-        preset.cfg_rescale = guidance_rescale if guidance_rescale is not None else await self.config.user(ctx.user).guidance_rescale()
-        preset.decrisper = decrisper if decrisper is not None else await self.config.user(ctx.user).decrisper()
-        preset.noise_schedule = noise_schedule or await self.config.user(ctx.user).noise_schedule()
+        preset.sampler = sampler or ImageSampler(settings["sampler"])
+        preset.scale = guidance if guidance is not None else settings["guidance"]
+        preset.cfg_rescale = guidance_rescale if guidance_rescale is not None else settings["guidance_rescale"]
+        preset.decrisper = decrisper if decrisper is not None else settings["decrisper"]
+        preset.noise_schedule = noise_schedule or settings["noise_schedule"]
         preset.seed = seed if seed else 0
         if "recommended" in preset.noise_schedule:
             preset.noise_schedule = "exponential" if "2m" in str(preset.sampler) else "native"
@@ -409,39 +477,56 @@ class NovelAI(commands.Cog):
             preset.noise_schedule = "native"
         preset.uncond_scale = 1.0
         if "ddim" not in str(preset.sampler):
-            sampler_version = sampler_version or await self.config.user(ctx.user).sampler_version()
+            sampler_version = sampler_version or settings["sampler_version"]
             preset.smea = "SMEA" in sampler_version
             preset.smea_dyn = "DYN" in sampler_version
         return prompt, preset
 
+    async def request_image(self, ctx: discord.Interaction, prompt: str, preset: ImagePreset, model: ImageModel,
+                            slot: Optional[Slot] = None) -> bytes:
+        for retry in range(4):
+            try:  # request block
+                async with self.api as wrapper:
+                    action = ImageGenerationType.IMG2IMG if preset._settings.get("image", None) else ImageGenerationType.NORMAL
+                    self.last_generation_datetime = datetime.now()
+                    async for _, img in wrapper.api.high_level.generate_image(prompt, model, preset, action):
+                        image_bytes = img
+                    self.limiter.succeeded()
+                    return image_bytes
+            except NovelAIError as error:
+                if error.status == 401 and retry == 0:  # the access token may have been revoked
+                    self.api.expire()
+                    continue
+                if error.status == 429:
+                    self.limiter.rate_limited()
+                if error.status not in (429, 500, 520, 408, 522, 524) or retry == 3:
+                    raise
+                if error.status == 429:
+                    log.warning(f"Rate limited, generating up to {self.limiter.limit} images at the same time.")
+                else:
+                    log.warning("NovelAI encountered an error." if error.status in (500, 520) else "Timed out.")
+                if retry == 1:
+                    await ctx.edit_original_response(content=self.loading_emoji + "`Generating image...` :warning:")
+                if error.status == 429 and slot:  # back off without the slot, so that the retry waits for the lowered limit
+                    slot.release()
+                    await asyncio.sleep(retry + 2)
+                    await slot.acquire()
+                else:
+                    await asyncio.sleep(retry + 2)
+
     async def fulfill_novelai_request(self,
                                       ctx: discord.Interaction,
                                       prompt: str,
                                       preset: ImagePreset,
                                       model: ImageModel,
                                       requester: Optional[int] = None,
-                                      callback: Optional[Coroutine] = None):
-        generation_cooldown = await self.config.generation_cooldown()
-        while (seconds := (datetime.now() - self.last_generation_datetime).total_seconds()) < generation_cooldown:
-            log.debug(f"Waiting on generation_cooldown... {seconds} seconds remaining.")
-            await asyncio.sleep(1)
+                                      callback: Optional[Coroutine] = None,
+                                      key: Optional[str] = None,
+                                      cached: Optional[bytes] = None,
+                                      slot: Optional[Slot] = None):
         try:  # callback block
             try:  # main block
-                for retry in range(4):
-                    try:  # request block
-                        async with self.api as wrapper:
-                            action = ImageGenerationType.IMG2IMG if preset._settings.get("image", None) else ImageGenerationType.NORMAL
-                            self.last_generation_datetime = datetime.now()
-                            async for _, img in wrapper.api.high_level.generate_image(prompt, model, preset, action):
-                                image_bytes = img
-                            break
-                    except NovelAIError as error:
-                        if error.status not in (500, 520, 408, 522, 524) or retry == 3:
-                            raise
-                        log.warning("NovelAI encountered an error." if error.status in (500, 520) else "Timed out.")
-                        if retry == 1:
-                            await ctx.edit_original_response(content=self.loading_emoji + "`Generating image...` :warning:")
-                        await asyncio.sleep(retry + 2)
+                image_bytes = cached if cached is not None else await self.request_image(ctx, prompt, preset, model, slot)
             except Exception as error:
                 view = RetryView(self, prompt, preset, model)
                 if isinstance(error, discord.errors.NotFound):
@@ -477,20 +562,8 @@ class NovelAI(commands.Cog):
                 self.generating[ctx.user.id] = False
                 self.user_last_img[ctx.user.id] = datetime.now()
 
-            image = Image.open(io.BytesIO(image_bytes))
-            comment = json.loads(image.info["Comment"])
-            seed = comment["seed"]
-            del comment["signed_hash"]
-            image.info["Comment"] = json.dumps(comment)
-            pnginfo = PngImagePlugin.PngInfo()
-            for key, val in image.info.items():
-                pnginfo.add_text(str(key), str(val))
-            fp = io.BytesIO()
-            image.save(fp, "png", pnginfo=pnginfo)
-            fp.seek(0)
-            image_bytes = fp.read()
-
-            name = md5(image_bytes).hexdigest() + ".png"
+            image_bytes, image_info, name = await asyncio.to_thread(process_generated_image, image_bytes)
+            seed = json.loads(image_info["Comment"])["seed"]
             file = discord.File(io.BytesIO(image_bytes), name)
             view = ImageView(self, prompt, preset, seed, model)
             content = f"{'Reroll' if callback else 'Retry'} requested by <@{requester}>" if requester and ctx.guild else None
@@ -500,9 +573,12 @@ class NovelAI(commands.Cog):
             imagescanner = self.bot.get_cog("ImageScanner")
             if imagescanner:
                 if imagescanner.always_scan_generated_images or ctx.channel.id in imagescanner.scan_channels:  # noqa
-                    img_info = imagescanner.convert_novelai_info(image.info)  # noqa
+                    img_info = imagescanner.convert_novelai_info(image_info)  # noqa
                     imagescanner.image_cache[msg.id] = ({1: img_info}, {1: image_bytes})  # noqa
                     await msg.add_reaction("🔎")
+
+            if key and cached is None:
+                await self.result_cache.put(key, image_bytes)
         except discord.errors.NotFound:
             pass
         except Exception:  # noqa, reason: unexpected errors should not interrupt the task queue
@@ -589,26 +665,28 @@ class NovelAI(commands.Cog):
             await self.config.user(ctx.user).reference_image_strength.set(reference_image_strength)
         if reference_image_info_extracted is not None:
             await self.config.user(ctx.user).reference_image_info_extracted.set(reference_image_info_extracted)
+        self.user_settings.pop(ctx.user.id, None)
 
+        settings = await self.get_user_settings(ctx.user)
         embed = discord.Embed(title="NovelAI default settings", color=0xffffff)
-        prompt = str(await self.config.user(ctx.user).base_prompt())
-        neg = str(await self.config.user(ctx.user).base_negative_prompt())
-        furry_prompt = str(await self.config.user(ctx.user).base_furry_prompt())
-        furry_neg = str(await self.config.user(ctx.user).base_furry_negative_prompt())
+        prompt = str(settings["base_prompt"])
+        neg = str(settings["base_negative_prompt"])
+        furry_prompt = str(settings["base_furry_prompt"])
+        furry_neg = str(settings["base_furry_negative_prompt"])
         embed.add_field(name="Base prompt", value=prompt[:1000] + "..." if len(prompt) > 1000 else prompt, inline=False)
         embed.add_field(name="Base negative prompt", value=neg[:1000] + "..." if len(neg) > 1000 else neg, inline=False)
         embed.add_field(name="Base furry prompt", value=furry_prompt[:1000] + "..." if len(furry_prompt) > 1000 else furry_prompt, inline=False)
         embed.add_field(name="Base furry negative prompt", value=furry_neg[:1000] + "..." if len(furry_neg) > 1000 else furry_neg, inline=False)
-        embed.add_field(name="Resolution", value=const.RESOLUTION_TITLES[await self.config.user(ctx.user).resolution()])
-        embed.add_field(name="Guidance", value=f"{await self.config.user(ctx.user).guidance():.1f}")
-        embed.add_field(name="Guidance Rescale", value=f"{await self.config.user(ctx.user).guidance_rescale():.2f}")
-        embed.add_field(name="Sampler", value=const.SAMPLER_TITLES[await self.config.user(ctx.user).sampler()])
-        embed.add_field(name="Sampler Version", value=await self.config.user(ctx.user).sampler_version())
-        embed.add_field(name="Noise Schedule", value=await self.config.user(ctx.user).noise_schedule())
-        embed.add_field(name="Decrisper", value=f"{await self.config.user(ctx.user).decrisper()}")
-        embed.add_field(name="Reference Image Strength", value=f"{await self.config.user(ctx.user).reference_image_strength():.2f}")
-        embed.add_field(name="Reference Information Extracted", value=f"{await self.config.user(ctx.user).reference_image_info_extracted():.2f}")
-        embed.add_field(name="Model", value=const.MODELS[await self.config.user(ctx.user).model()])
+        embed.add_field(name="Resolution", value=const.RESOLUTION_TITLES[settings["resolution"]])
+        embed.add_field(name="Guidance", value=f"{settings['guidance']:.1f}")
+        embed.add_field(name="Guidance Rescale", value=f"{settings['guidance_rescale']:.2f}")
+        embed.add_field(name="Sampler", value=const.SAMPLER_TITLES[settings["sampler"]])
+        embed.add_field(name="Sampler Version", value=settings["sampler_version"])
+        embed.add_field(name="Noise Schedule", value=settings["noise_schedule"])
+        embed.add_field(name="Decrisper", value=f"{settings['decrisper']}")
+        embed.add_field(name="Reference Image Strength", value=f"{settings['reference_image_strength']:.2f}")
+        embed.add_field(name="Reference Information Extracted", value=f"{settings['reference_image_info_extracted']:.2f}")
+        embed.add_field(name="Model", value=const.MODELS[settings["model"]])
         await ctx.response.send_message(embed=embed, ephemeral=True)
 
     @commands.group()
@@ -636,6 +714,18 @@ class NovelAI(commands.Cog):
             await self.config.generation_cooldown.set(max(0, seconds))
         await ctx.reply(f"Bot will globally submit generation requests to NovelAI every {max(0, seconds)} from its queue.")
 
+    @novelaiset.command()
+    @commands.is_owner()
+    async def concurrency(self, ctx: commands.Context, generations: Optional[int]):
+        """How many images may be generated at the same time. Fewer will be generated while NovelAI rate limits the bot."""
+        if generations is None:
+            generations = await self.config.concurrency()
+        else:
+            generations = min(const.MAX_CONCURRENCY, max(1, generations))
+            await self.config.concurrency.set(generations)
+            self.limiter.set_maximum(generations)
+        await ctx.reply(f"Bot will generate up to {generations} images at the same time, currently {self.limiter.limit}.")
+
     @novelaiset.command()
     @commands.is_owner()
     async def dmcooldown(self, ctx: commands.Context, seconds: Optional[int]):
@@ -679,6 +769,28 @@ class NovelAI(commands.Cog):
         else:
             await ctx.reply("NSFW filter disabled. Images may more easily be NSFW by accident.")
 
+    @novelaiset.command()
+    @commands.guild_only()
+    @commands.is_owner()
+    async def queueweight(self, ctx: commands.Context, weight: Optional[float]):
+        """How many images users in this server get generated for every one generated for users elsewhere, when the queue is busy."""
+        if weight is None:
+            weight = await self.config.guild(ctx.guild).queue_weight()
+        else:
+            weight = min(10.0, max(0.1, weight))
+            await self.config.guild(ctx.guild).queue_weight.set(weight)
+        await ctx.reply(f"Users in this server will have a queue weight of {weight:g}.")
+
+    @novelaiset.command()
+    @commands.is_owner()
+    async def resultcache(self, ctx: commands.Context):
+        """Shows how often requests with a seed were answered with an image generated before."""
+        requests = self.result_cache.hits + self.result_cache.misses
+        rate = f" ({self.result_cache.hits / requests:.0%})" if requests else ""
+        await ctx.reply(f"{len(self.result_cache)} images stored, using {self.result_cache.size / 1024 / 1024:.1f} MB "
+                        f"out of {self.result_cache.budget / 1024 / 1024:.0f} MB.\n"
+                        f"Since the bot started: {self.result_cache.hits} hits{rate} and {self.result_cache.misses} misses.")
+
     @novelaiset.command()
     @commands.is_owner()
     async def loadingemoji(self, ctx: commands.Context, emoji: Optional[discord.Emoji]):
@@ -0,0 +1,47 @@
+import json
+import zlib
+import struct
+from hashlib import md5
+from typing import Tuple, Dict
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def make_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def strip_signed_hash(image_bytes: bytes) -> Tuple[bytes, Dict[str, str]]:
+    """Removes the signed hash from the Comment of a NovelAI PNG by rewriting that single text chunk,
+    without decoding the image. Returns the new PNG and its text chunks."""
+    if not image_bytes.startswith(PNG_SIGNATURE):
+        raise ValueError("Not a PNG image")
+    view = memoryview(image_bytes)
+    parts = [view[:len(PNG_SIGNATURE)]]
+    info: Dict[str, str] = {}
+    position = len(PNG_SIGNATURE)
+    while position + 12 <= len(image_bytes):
+        length, chunk_type = struct.unpack_from(">I4s", image_bytes, position)
+        end = position + 12 + length
+        chunk = view[position:end]
+        if chunk_type == b"tEXt":
+            keyword, _, text = bytes(view[position + 8:end - 4]).partition(b"\0")
+            key, value = keyword.decode("latin-1"), text.decode("latin-1")
+            if key == "Comment":
+                comment = json.loads(value)
+                comment.pop("signed_hash", None)
+                value = json.dumps(comment)
+                chunk = make_chunk(b"tEXt", keyword + b"\0" + value.encode("latin-1"))
+            info[key] = value
+        parts.append(chunk)
+        position = end
+        if chunk_type == b"IEND":
+            break
+    return b"".join(parts), info
+
+
+def process_generated_image(image_bytes: bytes) -> Tuple[bytes, Dict[str, str], str]:
+    """Prepares a generated image to be sent, returning it along with its text chunks and a file name.
+    Meant to run outside the event loop."""
+    image_bytes, info = strip_signed_hash(image_bytes)
+    return image_bytes, info, md5(image_bytes).hexdigest() + ".png"
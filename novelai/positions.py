@@ -0,0 +1,68 @@
+import time
+import asyncio
+import discord
+from typing import Optional, Dict
+
+from novelai.constants import QUEUE_EDIT_DEBOUNCE, QUEUE_EDIT_INTERVAL
+
+
+class PositionUpdater:
+    """Keeps the "position in queue" messages up to date without flooding Discord with edits.
+    Queue changes are gathered for a moment, then only messages whose position changed are edited,
+    each one at most once every few seconds, and interactions that expired are left alone."""
+
+    def __init__(self, cog):
+        self.cog = cog
+        self.shown: Dict[int, int] = {}  # position last shown for each interaction
+        self.edited: Dict[int, float] = {}  # time of the last edit of each interaction
+        self.editing: Dict[int, asyncio.Task] = {}
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    def shown_position(self, ctx: discord.Interaction, position: int):
+        """Records the position the interaction was created with"""
+        self.shown[ctx.id] = position
+        self.edited[ctx.id] = time.monotonic()
+
+    def notify(self):
+        self.changed.set()
+
+    async def forget(self, ctx: discord.Interaction):
+        """Stops tracking an interaction that left the queue, waiting for any edit in progress so it doesn't arrive late"""
+        self.shown.pop(ctx.id, None)
+        self.edited.pop(ctx.id, None)
+        editing = self.editing.pop(ctx.id, None)
+        if editing:
+            await asyncio.gather(editing, return_exceptions=True)
+
+    async def run(self):
+        while True:
+            await self.changed.wait()
+            await asyncio.sleep(QUEUE_EDIT_DEBOUNCE)
+            self.changed.clear()
+            now = time.monotonic()
+            for position, (_, ctx, _) in enumerate(self.cog.queue, 1):
+                if self.shown.get(ctx.id) == position or ctx.is_expired():
+                    continue
+                if ctx.id in self.editing or now - self.edited.get(ctx.id, 0.0) < QUEUE_EDIT_INTERVAL:
+                    self.changed.set()  # try again after the next wait
+                    continue
+                self.shown[ctx.id] = position
+                self.edited[ctx.id] = now
+                self.editing[ctx.id] = asyncio.create_task(self.edit(ctx, position))
+
+    async def edit(self, ctx: discord.Interaction, position: int):
+        try:
+            await ctx.edit_original_response(content=self.cog.loading_emoji + f"`Position in queue: {position}`")
+        except discord.DiscordException:
+            pass  # low importance, it will be edited again when it leaves the queue
+        finally:
+            if self.editing.get(ctx.id) is asyncio.current_task():
+                del self.editing[ctx.id]
@@ -0,0 +1,92 @@
+import os
+import json
+import asyncio
+from hashlib import sha256
+from pathlib import Path
+from collections import OrderedDict
+from typing import Optional
+from novelai_api.ImagePreset import ImagePreset, ImageModel
+
+from novelai.constants import RESULT_CACHE_SIZE
+
+
+def result_key(prompt: str, preset: ImagePreset, model: ImageModel) -> Optional[str]:
+    """Hash of everything that determines a generated image, or None if it has a random seed"""
+    if not preset.seed:
+        return None
+    request = {"prompt": prompt, "model": str(model), "settings": preset._settings}  # noqa
+    return sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultCache:
+    """Generated images stored on disk by the hash of their request,
+    so requests with a fixed seed can be answered again without generating them.
+    The least recently used images are deleted to stay within a byte budget."""
+
+    def __init__(self, path: Path, budget: int = RESULT_CACHE_SIZE):
+        self.path = path
+        self.budget = budget
+        self.size = 0
+        self.entries: OrderedDict[str, int] = OrderedDict()  # file size of each key
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def file(self, key: str) -> Path:
+        return self.path.joinpath(key + ".png")
+
+    async def load(self):
+        def scan():
+            self.path.mkdir(parents=True, exist_ok=True)
+            files = sorted(self.path.glob("*.png"), key=lambda file: file.stat().st_mtime)
+            return [(file.stem, file.stat().st_size) for file in files]
+
+        for key, size in await asyncio.to_thread(scan):
+            self.entries[key] = size
+            self.size += size
+        await self.evict()
+
+    async def get(self, key: Optional[str]) -> Optional[bytes]:
+        if key is None:
+            return None
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        try:
+            data = await asyncio.to_thread(self.file(key).read_bytes)
+        except OSError:
+            self.size -= self.entries.pop(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        await asyncio.to_thread(os.utime, self.file(key))  # keeps the order across restarts
+        self.hits += 1
+        return data
+
+    async def put(self, key: str, data: bytes):
+        if len(data) > self.budget or key in self.entries:
+            return
+
+        def write():
+            temp = self.file(key).with_suffix(".tmp")
+            temp.write_bytes(data)
+            os.replace(temp, self.file(key))
+
+        await asyncio.to_thread(write)
+        self.entries[key] = len(data)
+        self.size += len(data)
+        await self.evict()
+
+    async def evict(self):
+        evicted = []
+        while self.size > self.budget:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            evicted.append(self.file(key))
+        if evicted:
+            await asyncio.to_thread(lambda: [file.unlink(missing_ok=True) for file in evicted])
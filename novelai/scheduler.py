@@ -0,0 +1,48 @@
+import heapq
+import itertools
+from typing import Generic, TypeVar, List, Tuple, Dict, Iterator
+
+T = TypeVar("T")
+
+
+class FairScheduler(Generic[T]):
+    """Priority queue that shares generations fairly between users.
+    Each item gets a virtual finish time one step after the previous item of the same user, so users are served
+    round-robin no matter how many items they queue. The step is shorter in guilds with a higher weight,
+    and VIP items are served before everyone else's. Adding and removing items costs O(log n),
+    only reporting positions goes through the whole queue."""
+
+    def __init__(self):
+        self._heap: List[Tuple[int, float, int, T]] = []
+        self._finish: Dict[int, float] = {}  # virtual finish time of each user's last item
+        self._clock = 0.0  # virtual finish time of the last item served
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __bool__(self) -> bool:
+        return bool(self._heap)
+
+    def __iter__(self) -> Iterator[T]:
+        """Items in the order they will be served"""
+        return (entry[-1] for entry in sorted(self._heap))
+
+    def push(self, item: T, user_id: int, weight: float = 1.0, vip: bool = False) -> Tuple[int, float, int]:
+        """Adds an item and returns the key it is ordered by"""
+        finish = max(self._clock, self._finish.get(user_id, 0.0)) + 1.0 / weight
+        self._finish[user_id] = finish
+        key = (0 if vip else 1, finish, next(self._counter))
+        heapq.heappush(self._heap, (*key, item))
+        return key
+
+    def position(self, key: Tuple[int, float, int]) -> int:
+        """1-based position in the queue of the item with the given key"""
+        return 1 + sum(1 for entry in self._heap if entry[:3] < key)
+
+    def pop(self) -> T:
+        _, self._clock, _, item = heapq.heappop(self._heap)
+        if not self._heap:  # nobody is behind anymore
+            self._finish.clear()
+            self._clock = 0.0
+        return item
@@ -0,0 +1,363 @@
+"""Benchmarks for the simulator model, which run without a Discord connection.
+Usage: python -m simulator.benchmark [memory] [generation] [rebuild] [engine] [--messages N] [--users N] [--seed N]
+       [--processes N] [--urls P] [--mentions P] [--emojis P] [--save FILE] [--compare FILE]"""
+
+import gc
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import asyncio
+import argparse
+import platform
+import itertools
+import statistics
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Tuple, Dict, Callable, Optional, List
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from simulator.constants import CHAIN_END, REBUILD_CHUNK_SIZE, COUNT_TOP_USERS
+from simulator.model import MarkovModel, UserModel, tokenize, START, END
+from simulator.snapshot import serialize_snapshot, write_snapshot, load_snapshot
+
+BENCHMARKS = ["memory", "generation", "rebuild", "engine"]
+WORDS = 20000
+SYMBOLS = ["!", "?", "...", " :)", " :(", ", ", ". ", " <3", " xD"]
+DOMAINS = ["youtube.com", "twitter.com", "tenor.com", "github.com", "reddit.com"]
+EMOJIS = 50
+PERCENTILES = (50, 90, 99)
+
+
+def generate_corpus(messages: int, users: int, seed: int = 0,
+                    urls: float = 0.0, mentions: float = 0.0, emojis: float = 0.0) -> Iterator[Tuple[int, str]]:
+    """Yields deterministic (user_id, content) pairs that resemble Discord chat,
+    with words following a zipfian distribution. Each message may also contain a link, a mention of another user
+    and a custom emoji, with the given probabilities."""
+    rng = random.Random(seed)
+    vocabulary = ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(1, 9))) for _ in range(WORDS)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(WORDS)))
+    user_ids = [rng.randrange(10 ** 17, 10 ** 18) for _ in range(users)]
+    user_cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(users)))
+    # a separate generator, so that the words are the same whatever the other options are
+    extras = random.Random(seed + 1)
+    emoji_names = [(extras.choice(vocabulary[:1000]), extras.randrange(10 ** 17, 10 ** 19)) for _ in range(EMOJIS)]
+    for _ in range(messages):
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(1, 20))
+        if urls and extras.random() < urls:
+            words.insert(extras.randint(0, len(words)), f"https://{extras.choice(DOMAINS)}/{extras.choice(vocabulary)}")
+        if mentions and extras.random() < mentions:
+            words.insert(extras.randint(0, len(words)), f"<@{extras.choice(user_ids)}>")
+        if emojis and extras.random() < emojis:
+            name, emoji_id = extras.choice(emoji_names)
+            words.insert(extras.randint(0, len(words)), f"<{'a' if emoji_id % 5 == 0 else ''}:{name}:{emoji_id}>")
+        content = " ".join(words)
+        if rng.random() < 0.2:
+            content += rng.choice(SYMBOLS)
+        yield rng.choices(user_ids, cum_weights=user_cum_weights)[0], content
+
+
+class LegacyModel:
+    """The original model, which stored every user's transitions as nested dictionaries of token strings."""
+
+    def __init__(self):
+        self.models: Dict[int, Dict[str, Dict[str, int]]] = {}
+
+    def add_message(self, user_id: int, content: str) -> bool:
+        tokens = tokenize(content)
+        if not tokens:
+            return False
+        model = self.models.setdefault(user_id, {})
+        previous = ""
+        for token in tokens:
+            model.setdefault(previous, {})
+            model[previous][token] = model[previous].get(token, 0) + 1
+            previous = token
+        return True
+
+    def walk(self, user_id: int) -> int:
+        """Generates a chain the original way, returning how many tokens it took"""
+        model = self.models[user_id]
+        token = ""
+        count = 0
+        while token != CHAIN_END:
+            token, = random.choices(population=list(model[token].keys()),
+                                    weights=list(model[token].values()),
+                                    k=1)
+            count += 1
+        return count
+
+
+def compact_walk(user: UserModel) -> int:
+    """Generates a chain using the sampling tables, returning how many tokens it took"""
+    token = START
+    count = 0
+    while token != END:
+        token = user.next_token(token)
+        count += 1
+    return count
+
+
+def measure_memory(factory: Callable, messages: int, users: int, seed: int, **corpus: float) -> Tuple[float, float]:
+    """Builds a model from the synthetic corpus, returning its size in MB and the seconds it took"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    model = factory()
+    for user_id, content in generate_corpus(messages, users, seed, **corpus):
+        model.add_message(user_id, content)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del model
+    return size / 2 ** 20, elapsed
+
+
+def measure_generation(messages: int, users: int, seed: int, generations: int, **corpus: float) -> Tuple[float, float]:
+    """Generates chains from both models, returning the nanoseconds per token of each"""
+    legacy, compact = LegacyModel(), MarkovModel()
+    for user_id, content in generate_corpus(messages, users, seed, **corpus):
+        legacy.add_message(user_id, content)
+        compact.add_message(user_id, content)
+    rng = random.Random(seed)
+    user_ids = rng.choices(list(compact.users.keys()), k=generations)
+    results = []
+    for walk in (legacy.walk, lambda uid: compact_walk(compact.users[uid])):
+        random.seed(seed)
+        start = time.perf_counter_ns()
+        tokens = sum(walk(uid) for uid in user_ids)
+        results.append((time.perf_counter_ns() - start) / tokens)
+    return results[0], results[1]
+
+
+def measure_fanout(successors: int, samples: int) -> Tuple[float, float]:
+    """Samples a single state with many successors, returning the nanoseconds per sample of each model"""
+    rng = random.Random(successors)
+    weights = {str(i): rng.randint(1, 100) for i in range(successors)}
+    user = UserModel(0)
+    for token, weight in enumerate(weights.values(), start=END + 1):
+        for _ in range(weight):
+            user.add_transition(START, token)
+    start = time.perf_counter_ns()
+    for _ in range(samples):
+        random.choices(population=list(weights.keys()), weights=list(weights.values()), k=1)
+    legacy_ns = (time.perf_counter_ns() - start) / samples
+    user.next_token(START)  # build the table outside of the timing
+    start = time.perf_counter_ns()
+    for _ in range(samples):
+        user.next_token(START)
+    compact_ns = (time.perf_counter_ns() - start) / samples
+    return legacy_ns, compact_ns
+
+
+def measure_rebuild(rows: List[Tuple[int, str]], processes: int) -> Tuple[float, float]:
+    """Builds a model inside an event loop, in the loop itself if processes is 0 or with add_messages otherwise.
+    Returns the seconds it took and the longest time the event loop was blocked."""
+    async def run() -> Tuple[float, float]:
+        blocked = 0.0
+
+        async def heartbeat():
+            nonlocal blocked
+            while True:
+                before = time.perf_counter()
+                await asyncio.sleep(0.01)
+                blocked = max(blocked, time.perf_counter() - before - 0.01)
+
+        async def source():  # like reading from the database, which gives control back to the loop
+            for i, row in enumerate(rows):
+                if i % 1000 == 0:
+                    await asyncio.sleep(0)
+                yield row
+
+        ticker = asyncio.create_task(heartbeat())
+        await asyncio.sleep(0.02)
+        model = MarkovModel()
+        start = time.perf_counter()
+        if processes == 0:
+            for user_id, content in rows:
+                model.add_message(user_id, content)
+        else:
+            with ProcessPoolExecutor(processes) as executor:
+                await model.add_messages(source(), executor, REBUILD_CHUNK_SIZE, 2 * processes)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.02)
+        ticker.cancel()
+        return elapsed, blocked
+
+    return asyncio.run(run())
+
+
+def peak_rss() -> Optional[float]:
+    """Most memory used by this process so far in MB, if the platform can tell"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10  # bytes on macOS, kilobytes elsewhere
+
+
+def percentiles(samples: List[float]) -> Dict[int, float]:
+    cuts = statistics.quantiles(samples, n=100)
+    return {p: cuts[p - 1] for p in PERCENTILES}
+
+
+def measure_engine(rows: List[Tuple[int, str]], generations: int) -> Dict[str, float]:
+    """Costs of the model as the cog uses it: building it, booting it from a snapshot, generating messages,
+    and the stats and count commands. Returns them by name."""
+    results = {}
+    gc.collect()
+    model = MarkovModel()
+    start = time.perf_counter()
+    for user_id, content in rows:
+        model.add_message(user_id, content)
+    results["build_msgs_per_s"] = len(rows) / (time.perf_counter() - start)
+    results["model_mb"] = model.stats().size / 2 ** 20
+    with TemporaryDirectory() as directory:
+        path = Path(directory, "model.snapshot")
+        start = time.perf_counter()
+        write_snapshot(path, serialize_snapshot(model, len(rows)))
+        results["snapshot_save_s"] = time.perf_counter() - start
+        results["snapshot_mb"] = path.stat().st_size / 2 ** 20
+        start = time.perf_counter()
+        snapshot = load_snapshot(path)
+        results["boot_s"] = time.perf_counter() - start
+        del snapshot
+    rss = peak_rss()
+    if rss is not None:
+        results["peak_rss_mb"] = rss
+
+    random.seed(0)
+    token_ns, message_us = [], []
+    for _ in range(generations):
+        user = model.pick_user()
+        start = time.perf_counter_ns()
+        tokens = compact_walk(user)
+        token_ns.append((time.perf_counter_ns() - start) / tokens)
+        start = time.perf_counter_ns()
+        model.generate_message()
+        message_us.append((time.perf_counter_ns() - start) / 1000)
+    for p, value in percentiles(token_ns).items():
+        results[f"token_p{p}_ns"] = value
+    for p, value in percentiles(message_us).items():
+        results[f"message_p{p}_us"] = value
+
+    repeats = 1000
+    start = time.perf_counter_ns()
+    for _ in range(repeats):
+        model.stats()
+    results["stats_us"] = (time.perf_counter_ns() - start) / repeats / 1000
+    start = time.perf_counter()
+    model.measure()
+    results["stats_exact_s"] = time.perf_counter() - start
+    word = max(range(END + 1, len(model.vocabulary)), key=model.occurrences, default=END)
+    start = time.perf_counter_ns()
+    for _ in range(repeats // 10):  # what the count command does for a common word
+        model.occurrences(word), model.successors(word)
+        heapq.nlargest(COUNT_TOP_USERS, ((user.occurrences(word), user_id) for user_id, user in model.users.items()))
+    results["count_us"] = (time.perf_counter_ns() - start) / (repeats // 10) / 1000
+    return results
+
+
+def compare(baseline: dict, results: Dict[str, float], options: dict):
+    """Prints how much every result changed from a baseline saved by an earlier run"""
+    print(f"Compared to {baseline.get('label') or 'baseline'} (Python {baseline.get('python', '?')}):")
+    changed = [key for key in ("messages", "users", "seed", "urls", "mentions", "emojis")
+               if baseline.get("options", {}).get(key) != options.get(key)]
+    if changed:
+        print(f"  warning, different options: {', '.join(changed)}")
+    for key, value in results.items():
+        old = baseline.get("results", {}).get(key)
+        if old is None:
+            print(f"  {key:>28}: {value:12.2f}  (new)")
+        else:
+            change = f"{100 * (value / old - 1):+7.1f} %" if old else ""
+            print(f"  {key:>28}: {old:12.2f} -> {value:12.2f}  {change}")
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmarks", nargs="*", help=f"any of: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--generations", type=int, default=10_000)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="most processes to try in the rebuild")
+    parser.add_argument("--urls", type=float, default=0.05, help="chance of a message containing a link")
+    parser.add_argument("--mentions", type=float, default=0.1, help="chance of a message mentioning a user")
+    parser.add_argument("--emojis", type=float, default=0.05, help="chance of a message containing a custom emoji")
+    parser.add_argument("--save", type=Path, help="write the results to this JSON file, to compare with later")
+    parser.add_argument("--compare", type=Path, help="compare the results with a JSON file written by --save")
+    parser.add_argument("--label", default="", help="name for the results in the JSON file, such as a version")
+    args = parser.parse_args(args)
+    benchmarks = args.benchmarks or BENCHMARKS
+    if any(name not in BENCHMARKS for name in benchmarks):
+        parser.error(f"benchmarks must be any of: {', '.join(BENCHMARKS)}")
+    corpus = {"urls": args.urls, "mentions": args.mentions, "emojis": args.emojis}
+    results: Dict[str, float] = {}
+
+    if "engine" in benchmarks:  # first, so that the peak memory isn't from the other benchmarks
+        print(f"Simulator engine on {args.messages:,} synthetic messages from {args.users} users")
+        rows = list(generate_corpus(args.messages, args.users, args.seed, **corpus))
+        engine = measure_engine(rows, args.generations)
+        del rows
+        print(f"  build:      {engine['build_msgs_per_s']:9,.0f} msgs/s, ~{engine['model_mb']:.1f} MB model")
+        if "peak_rss_mb" in engine:
+            print(f"  peak RSS:   {engine['peak_rss_mb']:9.1f} MB")
+        print(f"  snapshot:   {engine['snapshot_mb']:9.1f} MB, saved in {engine['snapshot_save_s']:.2f}s, "
+              f"booted in {engine['boot_s']:.2f}s")
+        print("  generation: " + ", ".join(f"p{p} {engine[f'token_p{p}_ns']:.0f} ns/token" for p in PERCENTILES))
+        print("              " + ", ".join(f"p{p} {engine[f'message_p{p}_us']:.0f} µs/message" for p in PERCENTILES))
+        print(f"  stats:      {engine['stats_us']:9.1f} µs, {engine['stats_exact_s']:.2f}s with --exact")
+        print(f"  count:      {engine['count_us']:9.1f} µs")
+        results.update({f"engine.{key}": value for key, value in engine.items()})
+
+    if "memory" in benchmarks:
+        print(f"Memory comparison on {args.messages:,} synthetic messages from {args.users} users")
+        legacy_mb, legacy_s = measure_memory(LegacyModel, args.messages, args.users, args.seed, **corpus)
+        print(f"  dict model:    {legacy_mb:9.2f} MB  (built in {legacy_s:.1f}s)")
+        compact_mb, compact_s = measure_memory(MarkovModel, args.messages, args.users, args.seed, **corpus)
+        print(f"  compact model: {compact_mb:9.2f} MB  (built in {compact_s:.1f}s)")
+        print(f"  reduction:     {100 * (1 - compact_mb / legacy_mb):9.1f} %")
+        results.update({"memory.legacy_mb": legacy_mb, "memory.compact_mb": compact_mb})
+
+    if "generation" in benchmarks:
+        print(f"Generation latency over {args.generations:,} messages, model of {args.messages:,} messages")
+        legacy_ns, compact_ns = measure_generation(args.messages, args.users, args.seed, args.generations, **corpus)
+        print(f"  random.choices: {legacy_ns:9.0f} ns/token")
+        print(f"  sampling table: {compact_ns:9.0f} ns/token")
+        results.update({"generation.legacy_ns": legacy_ns, "generation.compact_ns": compact_ns})
+        print("Sampling latency by number of successors of a state")
+        for successors in (10, 100, 1_000, 10_000, 100_000):
+            legacy_ns, compact_ns = measure_fanout(successors, 1000)
+            print(f"  {successors:>7,}: random.choices {legacy_ns:11.0f} ns, sampling table {compact_ns:6.0f} ns")
+
+    if "rebuild" in benchmarks:
+        print(f"Rebuild of a model of {args.messages:,} messages inside an event loop")
+        rows = list(generate_corpus(args.messages, args.users, args.seed, **corpus))
+        counts = [0] + [n for n in (1, 2, 4, 8, 16, 32) if n < args.processes] + [args.processes]
+        for processes in counts:
+            elapsed, blocked = measure_rebuild(rows, processes)
+            name = "event loop" if processes == 0 else f"{processes} processes"
+            print(f"  {name:>12}: {elapsed:6.1f}s, {len(rows) / elapsed:9,.0f} msgs/s, loop blocked for {blocked * 1000:8.0f} ms at most")
+            results[f"rebuild.{processes}_msgs_per_s"] = len(rows) / elapsed
+
+    options = {"messages": args.messages, "users": args.users, "seed": args.seed, "generations": args.generations, **corpus}
+    if args.compare:
+        compare(json.loads(args.compare.read_text()), results, options)
+    if args.save:
+        baseline = {"label": args.label, "python": platform.python_version(), "platform": platform.platform(),
+                    "options": options, "results": results}
+        args.save.write_text(json.dumps(baseline, indent=2))
+        print(f"Saved results to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
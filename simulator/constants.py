@@ -0,0 +1,58 @@
+import re
+import logging
+
+log = logging.getLogger("red.crab-cogs.simulator")
+
+WEBHOOK_NAME = "Simulator"
+DB_FILE = "messages.db"
+DB_TABLE_MESSAGES = "messages"
+DB_TABLE_CHECKPOINTS = "feed_checkpoints"
+DB_TABLE_CHANGES = "pending_changes"
+DB_TABLE_VOCABULARY = "vocabulary"
+DB_TABLE_SEARCH = "messages_search"
+DB_TABLE_SEARCH_BACKFILL = "search_backfill"
+COMMIT_SIZE = 1000
+COMMIT_INTERVAL = 2  # seconds
+FEED_CONCURRENCY = 3  # channels read at the same time
+FEED_QUEUE_SIZE = 2000
+FEED_BATCH_SIZE = 200  # messages checked against the database at once
+FEED_PROGRESS_INTERVAL = 5  # seconds
+SNAPSHOT_FILE = "model.snapshot"
+SNAPSHOT_VERSION = 4
+REBUILD_PROCESSES = 4  # at most, leaving one core for the bot
+REBUILD_CHUNK_SIZE = 5000  # messages tokenized by a process at once
+COUNT_TOP_USERS = 5
+SEARCH_SAMPLES = 3
+MEMORY_BUDGET = 0  # MB of models kept loaded, 0 for no limit
+WINDOW_DAYS = 0  # days of messages in the model, 0 for all of them
+WINDOW_INTERVAL = 600  # seconds between removals of messages that left the window
+GENERATION_BUFFER_SIZE = 3  # messages generated ahead of time
+RATE_LIMIT_RETRIES = 3
+
+CHAIN_END = "🔚"
+TOKENIZER = re.compile(
+    r"( ?https?://[^\s>]+"                # URLs
+    r"| ?<(@|#|@!|@&|a?:\w+:)\d{10,20}>"  # mentions, emojis
+    r"| ?@everyone| ?@here"               # pings
+    r"| ?[\w'-]+"                         # words
+    r"|[^\w<]+|<)"                        # symbols
+)
+SUBTOKENIZER = re.compile(
+    r"( ?https?://(?=[^\s>])|(?<=://)[^\s>]+"         # URLs
+    r"| ?<a?:(?=\w)|(?<=:)\w+:\d{10,20}>"             # emojis
+    r"| ?<[@#](?=[\d&!])|(?<=[@#])[!&]?\d{10,20}>)"   # mentions
+)
+
+COMMENT_DELAY = 5
+CONVERSATION_DELAY = 30
+CONVERSATION_MIN = 4
+CONVERSATION_MAX = 15
+
+EMOJI_LOADING = '⌛'
+EMOJI_SUCCESS = '✅'
+
+ERROR_CONFIG = "You must configure the simulator input role, input channels and output channel. They must be in the same guild."
+ERROR_SETUP = "Failed to set up the simulator. Make sure it is configured correctly and check your logs for errors."
+ERROR_FEEDING = "The simulator is currently feeding on past messages. Please wait a few minutes."
+ERROR_BOOTING = "The simulator is booting up. Wait a minute for it to finish."
+ERROR_CHANNELS = "A channel cannot be simulator input and output at the same time."
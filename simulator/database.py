@@ -0,0 +1,414 @@
+import asyncio
+import discord
+import aiosqlite as sql
+from pathlib import Path
+from itertools import groupby
+from typing import Optional, List, Tuple, Union, Dict, Set, AsyncIterator
+
+from simulator.constants import log, DB_TABLE_MESSAGES, DB_TABLE_CHECKPOINTS, DB_TABLE_CHANGES, DB_TABLE_VOCABULARY, \
+    DB_TABLE_SEARCH, DB_TABLE_SEARCH_BACKFILL, COMMIT_SIZE, COMMIT_INTERVAL, CHAIN_END
+from simulator.model import tokenize, encode_tokens, decode_tokens
+
+Write = Tuple[str, tuple]
+
+INSERT_MESSAGE = f"INSERT OR REPLACE INTO {DB_TABLE_MESSAGES} (id, user_id, content, timestamp, tokens) VALUES (?, ?, ?, ?, ?)"
+ENCODE_MESSAGE = f"UPDATE {DB_TABLE_MESSAGES} SET tokens = ? WHERE id = ? AND tokens IS NULL"  # not if replaced meanwhile
+PRUNE_VOCABULARY = "PRUNE VOCABULARY"  # not a query, the writer prunes the vocabulary at the end of the batch
+NEXT_TOKEN_ID = f"SELECT COALESCE(MAX(id), 1) + 1 FROM {DB_TABLE_VOCABULARY}"  # ids of pruned tokens aren't given out again
+
+# Each migration upgrades the schema by one version, tracked with PRAGMA user_version
+MIGRATIONS = [
+    # token ids of every message, so that the model can be rebuilt without tokenizing them again
+    [f"ALTER TABLE {DB_TABLE_MESSAGES} ADD COLUMN tokens BLOB",
+     f"CREATE TABLE {DB_TABLE_VOCABULARY} (id INTEGER PRIMARY KEY, token TEXT NOT NULL UNIQUE)",
+     f"INSERT INTO {DB_TABLE_VOCABULARY} VALUES (0, ''), (1, '{CHAIN_END}')",
+     f"CREATE INDEX {DB_TABLE_MESSAGES}_user_id ON {DB_TABLE_MESSAGES} (user_id)"],
+    # when each message was sent in milliseconds, as in its snowflake id, to only keep recent ones in the model
+    [f"ALTER TABLE {DB_TABLE_MESSAGES} ADD COLUMN timestamp INTEGER",
+     f"UPDATE {DB_TABLE_MESSAGES} SET timestamp = (id >> 22) + {discord.utils.DISCORD_EPOCH}",
+     f"CREATE INDEX {DB_TABLE_MESSAGES}_timestamp ON {DB_TABLE_MESSAGES} (timestamp)"],
+    # full-text index of the messages, kept up to date by triggers except for the older messages still being backfilled
+    [f"CREATE VIRTUAL TABLE {DB_TABLE_SEARCH} USING fts5(content, content='{DB_TABLE_MESSAGES}', content_rowid='id')",
+     f"CREATE TABLE {DB_TABLE_SEARCH_BACKFILL} (last_id INTEGER NOT NULL, until_id INTEGER NOT NULL)",
+     f"INSERT INTO {DB_TABLE_SEARCH_BACKFILL} SELECT 0, COALESCE(MAX(id), 0) FROM {DB_TABLE_MESSAGES}",
+     f"CREATE TRIGGER {DB_TABLE_SEARCH}_insert AFTER INSERT ON {DB_TABLE_MESSAGES} "
+     f"WHEN NOT EXISTS (SELECT 1 FROM {DB_TABLE_SEARCH_BACKFILL} WHERE new.id > last_id AND new.id <= until_id) BEGIN "
+     f"INSERT INTO {DB_TABLE_SEARCH} (rowid, content) VALUES (new.id, new.content); END",
+     f"CREATE TRIGGER {DB_TABLE_SEARCH}_delete AFTER DELETE ON {DB_TABLE_MESSAGES} "
+     f"WHEN NOT EXISTS (SELECT 1 FROM {DB_TABLE_SEARCH_BACKFILL} WHERE old.id > last_id AND old.id <= until_id) BEGIN "
+     f"INSERT INTO {DB_TABLE_SEARCH} ({DB_TABLE_SEARCH}, rowid, content) VALUES ('delete', old.id, old.content); END",
+     f"CREATE TRIGGER {DB_TABLE_SEARCH}_update AFTER UPDATE OF content ON {DB_TABLE_MESSAGES} "
+     f"WHEN NOT EXISTS (SELECT 1 FROM {DB_TABLE_SEARCH_BACKFILL} WHERE old.id > last_id AND old.id <= until_id) BEGIN "
+     f"INSERT INTO {DB_TABLE_SEARCH} ({DB_TABLE_SEARCH}, rowid, content) VALUES ('delete', old.id, old.content); "
+     f"INSERT INTO {DB_TABLE_SEARCH} (rowid, content) VALUES (new.id, new.content); END"],
+]
+
+
+def search_phrase(phrase: str) -> str:
+    """Quotes text to be matched as a whole phrase, so that it can't use the full-text query syntax"""
+    return '"' + phrase.replace('"', '""') + '"'
+
+
+def snowflake_timestamp(snowflake: int) -> int:
+    """Milliseconds since the Unix epoch when a Discord object was created"""
+    return (snowflake >> 22) + discord.utils.DISCORD_EPOCH
+
+
+class MessageDatabase:
+    """A single long-lived connection to the messages database.
+    Writes are put in a queue, and a background task commits them in batches of executemany calls."""
+
+    def __init__(self, path: Path, batch_size: int = COMMIT_SIZE, flush_interval: float = COMMIT_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.connection: Optional[sql.Connection] = None
+        self.queue: asyncio.Queue[Union[Write, List[Write], asyncio.Future]] = asyncio.Queue()  # lists are written in the same commit
+        self.writer_task: Optional[asyncio.Task] = None
+        self.backfill_task: Optional[asyncio.Task] = None
+        self.open_lock = asyncio.Lock()
+        self.next_token_id = 0
+
+    async def open(self):
+        async with self.open_lock:
+            if self.connection:
+                return
+            self.connection = await sql.connect(self.path)
+            await self.connection.execute("PRAGMA journal_mode=WAL")
+            await self.connection.execute("PRAGMA synchronous=NORMAL")
+            await self.connection.execute("PRAGMA recursive_triggers=ON")  # so that INSERT OR REPLACE updates the search index
+            await self.connection.execute(f"CREATE TABLE IF NOT EXISTS {DB_TABLE_MESSAGES} "
+                                          f"(id INTEGER PRIMARY KEY, user_id INTEGER, content TEXT NOT NULL);")
+            await self.connection.execute(f"CREATE TABLE IF NOT EXISTS {DB_TABLE_CHECKPOINTS} "
+                                          f"(channel_id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL);")
+            await self.connection.execute(f"CREATE TABLE IF NOT EXISTS {DB_TABLE_CHANGES} "
+                                          f"(id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER NOT NULL, "
+                                          f"user_id INTEGER, content TEXT NOT NULL, removed INTEGER NOT NULL);")
+            await self.connection.commit()
+            await self.migrate()
+            async with self.connection.execute(NEXT_TOKEN_ID) as cursor:
+                self.next_token_id, = await cursor.fetchone()
+            self.writer_task = asyncio.create_task(self.writer())
+            self.backfill_task = asyncio.create_task(self.backfill())
+
+    async def migrate(self):
+        async with self.connection.execute("PRAGMA user_version") as cursor:
+            version, = await cursor.fetchone()
+        for version in range(version, len(MIGRATIONS)):
+            try:
+                await self.connection.execute("BEGIN")  # otherwise schema changes are committed one by one
+                for statement in MIGRATIONS[version]:
+                    await self.connection.execute(statement)
+                await self.connection.execute(f"PRAGMA user_version = {version + 1}")
+                await self.connection.commit()
+            except Exception:
+                await self.connection.rollback()
+                raise
+            log.info(f"Migrated simulator database {self.path} to version {version + 1}")
+
+    async def close(self):
+        """Writes everything left in the queue and closes the connection"""
+        if self.backfill_task:
+            self.backfill_task.cancel()
+        if self.writer_task and not self.writer_task.done():
+            await self.flush()
+            self.writer_task.cancel()
+        if self.connection:
+            await self.connection.close()
+            self.connection = None
+
+    # Writes
+
+    def insert(self, message_id: int, user_id: int, content: str):
+        self.queue.put_nowait((INSERT_MESSAGE, (message_id, user_id, content, snowflake_timestamp(message_id))))  # the writer adds the tokens
+
+    def delete(self, message_id: int):
+        self.queue.put_nowait((f"DELETE FROM {DB_TABLE_MESSAGES} WHERE id = ?", (message_id,)))
+
+    def delete_user(self, user_id: int):
+        self.queue.put_nowait((f"DELETE FROM {DB_TABLE_MESSAGES} WHERE user_id = ?", (user_id,)))
+        self.queue.put_nowait((f"DELETE FROM {DB_TABLE_CHANGES} WHERE user_id = ?", (user_id,)))
+
+    def clear(self):
+        self.queue.put_nowait((f"DELETE FROM {DB_TABLE_MESSAGES}", ()))
+        self.queue.put_nowait((f"DELETE FROM {DB_TABLE_CHECKPOINTS}", ()))
+        self.queue.put_nowait((f"DELETE FROM {DB_TABLE_CHANGES}", ()))
+        self.prune_vocabulary()  # quick with no messages left
+
+    def prune_vocabulary(self):
+        """Removes the tokens that no message uses anymore. It reads every message, so it's only done during full rebuilds."""
+        self.queue.put_nowait((PRUNE_VOCABULARY, ()))
+
+    def set_checkpoint(self, channel_id: int, message_id: int):
+        """Remembers the last message read from a channel while feeding"""
+        self.queue.put_nowait((f"INSERT OR REPLACE INTO {DB_TABLE_CHECKPOINTS} VALUES (?, ?)", (channel_id, message_id)))
+
+    def record_change(self, message_id: int, user_id: int, content: str, removed: bool):
+        """Remembers a message that must be added to or removed from the model next time it's loaded"""
+        self.queue.put_nowait((f"INSERT INTO {DB_TABLE_CHANGES} (message_id, user_id, content, removed) VALUES (?, ?, ?, ?)",
+                               (message_id, user_id, content, int(removed))))
+
+    def clear_changes(self, until_id: int):
+        self.queue.put_nowait((f"DELETE FROM {DB_TABLE_CHANGES} WHERE id <= ?", (until_id,)))
+
+    async def flush(self):
+        """Waits until every write queued so far has been committed"""
+        if not self.writer_task or self.writer_task.done():
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(future)
+        await future
+
+    async def writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size and not isinstance(batch[-1], asyncio.Future):
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.write(batch)
+
+    async def write(self, batch: List[Union[Write, List[Write], asyncio.Future]]):
+        writes = [write for item in batch if not isinstance(item, asyncio.Future)
+                  for write in (item if isinstance(item, list) else [item])]
+        prune = any(query == PRUNE_VOCABULARY for query, _ in writes)
+        try:
+            writes = await self.encode([write for write in writes if write[0] != PRUNE_VOCABULARY])
+            for query, group in groupby(writes, key=lambda write: write[0]):
+                await self.connection.executemany(query, [params for _, params in group])
+            if prune:  # after every write, so that the tokens of the messages inserted in this batch are kept
+                await self.remove_unused_tokens()
+            await self.connection.commit()
+        except Exception:  # noqa, reason: a failed batch should not stop the writer
+            log.exception("Writing to simulator database")
+            await self.connection.rollback()
+            async with self.connection.execute(NEXT_TOKEN_ID) as cursor:
+                self.next_token_id, = await cursor.fetchone()
+        finally:
+            for item in batch:
+                if isinstance(item, asyncio.Future) and not item.done():
+                    item.set_result(None)
+
+    async def encode(self, writes: List[Write]) -> List[Write]:
+        """Adds the token ids of the messages being written, adding new tokens to the vocabulary.
+        Only the writer calls this, so ids are given out in order."""
+        contents = [params[2] if query == INSERT_MESSAGE else params[1] for query, params in writes
+                    if query == INSERT_MESSAGE or query == ENCODE_MESSAGE]
+        if not contents:
+            return writes
+        messages = await asyncio.to_thread(lambda: [tokenize(content)[:-1] for content in contents])
+        distinct = list({token for tokens in messages for token in tokens})
+        token_ids = {}
+        for i in range(0, len(distinct), 500):
+            chunk = distinct[i:i+500]
+            placeholders = ", ".join("?" for _ in chunk)
+            async with self.connection.execute(f"SELECT token, id FROM {DB_TABLE_VOCABULARY} "
+                                               f"WHERE token IN ({placeholders})", chunk) as cursor:
+                token_ids.update(await cursor.fetchall())
+        new_tokens = [token for token in distinct if token not in token_ids]
+        if new_tokens:
+            new_ids = range(self.next_token_id, self.next_token_id + len(new_tokens))
+            await self.connection.executemany(f"INSERT INTO {DB_TABLE_VOCABULARY} VALUES (?, ?)", zip(new_ids, new_tokens))
+            token_ids.update(zip(new_tokens, new_ids))
+            self.next_token_id += len(new_tokens)
+        blobs = iter([encode_tokens(token_ids[token] for token in tokens) for tokens in messages])
+        encoded = []
+        for query, params in writes:
+            if query == INSERT_MESSAGE:
+                params = params + (next(blobs),)
+            elif query == ENCODE_MESSAGE:
+                params = (next(blobs), params[0])
+            encoded.append((query, params))
+        return encoded
+
+    async def remove_unused_tokens(self):
+        """Deletes the tokens that no message uses. The others keep their ids, so no message has to be encoded again.
+        Only the writer calls this, in the same commit as the writes before it."""
+        used = {0, 1}  # the empty token and CHAIN_END
+        async for rows in self.encoded_chunks():
+            await asyncio.to_thread(lambda: [used.update(decode_tokens(blob)) for _, blob in rows])
+        async with self.connection.execute(f"SELECT id FROM {DB_TABLE_VOCABULARY}") as cursor:
+            unused = [(token_id,) for token_id, in await cursor.fetchall() if token_id not in used]
+        if unused:
+            await self.connection.executemany(f"DELETE FROM {DB_TABLE_VOCABULARY} WHERE id = ?", unused)
+            log.info(f"Removed {len(unused)} unused tokens from simulator database {self.path}")
+
+    async def encoded_chunks(self) -> AsyncIterator[List[Tuple[int, bytes]]]:
+        """The token ids of every message, a batch at a time"""
+        last_id = 0
+        while True:
+            async with self.connection.execute(f"SELECT id, tokens FROM {DB_TABLE_MESSAGES} WHERE id > ? AND tokens IS NOT NULL "
+                                               f"ORDER BY id LIMIT ?", [last_id, self.batch_size]) as cursor:
+                rows = list(await cursor.fetchall())
+            if not rows:
+                break
+            yield rows
+            last_id = rows[-1][0]
+
+    async def backfill(self):
+        """Fills in what older versions didn't store, a batch at a time"""
+        await self.backfill_tokens()
+        await self.backfill_search()
+
+    async def backfill_tokens(self):
+        """Encodes the messages stored before the tokens column existed"""
+        last_id = 0
+        encoded = 0
+        while True:
+            await self.flush()
+            async with self.connection.execute(f"SELECT id, content FROM {DB_TABLE_MESSAGES} WHERE id > ? AND tokens IS NULL "
+                                               f"ORDER BY id LIMIT ?", [last_id, self.batch_size]) as cursor:
+                rows = list(await cursor.fetchall())
+            if not rows:
+                break
+            for message_id, content in rows:
+                self.queue.put_nowait((ENCODE_MESSAGE, (message_id, content)))  # the writer replaces the content with the tokens
+            last_id = rows[-1][0]
+            encoded += len(rows)
+        if encoded:
+            log.info(f"Stored the tokens of {encoded} messages in simulator database {self.path}")
+
+    async def backfill_search(self):
+        """Adds the messages stored before the search index existed to it. Meanwhile, the triggers leave them alone."""
+        indexed = 0
+        while True:
+            await self.flush()
+            async with self.connection.execute(f"SELECT last_id, until_id FROM {DB_TABLE_SEARCH_BACKFILL}") as cursor:
+                progress = await cursor.fetchone()
+            if progress is None:
+                break
+            last_id, until_id = progress
+            async with self.connection.execute(f"SELECT id FROM {DB_TABLE_MESSAGES} WHERE id > ? AND id <= ? "
+                                               f"ORDER BY id LIMIT ?", [last_id, until_id, self.batch_size]) as cursor:
+                batch = [message_id for message_id, in await cursor.fetchall()]
+            if not batch:
+                self.queue.put_nowait((f"DELETE FROM {DB_TABLE_SEARCH_BACKFILL}", ()))
+                continue
+            # committed together, or a crash in between would index the same rows twice on restart,
+            # and the rows are selected again in case they changed
+            self.queue.put_nowait([
+                (f"INSERT INTO {DB_TABLE_SEARCH} (rowid, content) SELECT id, content FROM {DB_TABLE_MESSAGES} "
+                 f"WHERE id > ? AND id <= ?", (last_id, batch[-1])),
+                (f"UPDATE {DB_TABLE_SEARCH_BACKFILL} SET last_id = ?", (batch[-1],)),
+            ])
+            indexed += len(batch)
+        if indexed:
+            log.info(f"Indexed {indexed} messages for search in simulator database {self.path}")
+
+    @property
+    def search_backfilled(self) -> bool:
+        return bool(self.backfill_task and self.backfill_task.done())
+
+    # Reads, which see every write queued before them
+
+    async def fetch_messages(self, message_ids: List[int]) -> List[Tuple[int, int, str]]:
+        await self.flush()
+        placeholders = ", ".join("?" for _ in message_ids)
+        async with self.connection.execute(f"SELECT id, user_id, content FROM {DB_TABLE_MESSAGES} "
+                                           f"WHERE id IN ({placeholders})", message_ids) as cursor:
+            return list(await cursor.fetchall())
+
+    async def existing_ids(self, message_ids: List[int]) -> Set[int]:
+        await self.flush()
+        placeholders = ", ".join("?" for _ in message_ids)
+        async with self.connection.execute(f"SELECT id FROM {DB_TABLE_MESSAGES} WHERE id IN ({placeholders})", message_ids) as cursor:
+            return {row[0] for row in await cursor.fetchall()}
+
+    async def fetch_checkpoints(self) -> Dict[int, int]:
+        await self.flush()
+        async with self.connection.execute(f"SELECT channel_id, message_id FROM {DB_TABLE_CHECKPOINTS}") as cursor:
+            return {channel_id: message_id for channel_id, message_id in await cursor.fetchall()}
+
+    async def fetch_changes(self) -> List[Tuple[int, int, int, str, bool]]:
+        await self.flush()
+        async with self.connection.execute(f"SELECT id, message_id, user_id, content, removed FROM {DB_TABLE_CHANGES} "
+                                           f"ORDER BY id") as cursor:
+            return [(change_id, message_id, user_id, content, bool(removed))
+                    for change_id, message_id, user_id, content, removed in await cursor.fetchall()]
+
+    async def count_messages(self, until_id: int, since: int = 0) -> int:
+        """Messages up to the given id that were sent after the given timestamp"""
+        await self.flush()
+        async with self.connection.execute(f"SELECT COUNT(*) FROM {DB_TABLE_MESSAGES} WHERE id <= ? AND timestamp > ?",
+                                           [until_id, since]) as cursor:
+            count, = await cursor.fetchone()
+        return count
+
+    async def fetch_vocabulary(self, start_id: int = 0) -> List[Tuple[int, str]]:
+        """Every token from the given id onwards with its id, in order. Ids of removed tokens are skipped."""
+        await self.flush()
+        async with self.connection.execute(f"SELECT id, token FROM {DB_TABLE_VOCABULARY} WHERE id >= ? ORDER BY id", [start_id]) as cursor:
+            return list(await cursor.fetchall())
+
+    async def is_encoded(self) -> bool:
+        """Whether the tokens of every message are stored"""
+        await self.flush()
+        async with self.connection.execute(f"SELECT EXISTS (SELECT 1 FROM {DB_TABLE_MESSAGES} WHERE tokens IS NULL)") as cursor:
+            missing, = await cursor.fetchone()
+        return not missing
+
+    async def iterate_encoded(self, since: int = 0) -> AsyncIterator[Tuple[int, int, bytes]]:
+        """Every message sent after the given timestamp, with its token ids instead of its content"""
+        await self.flush()
+        async with self.connection.execute(f"SELECT id, user_id, tokens FROM {DB_TABLE_MESSAGES} "
+                                           f"WHERE timestamp > ? ORDER BY id", [since]) as cursor:
+            async for row in cursor:
+                yield row
+
+    async def iterate_messages(self, after_id: int = 0, since: int = 0) -> AsyncIterator[Tuple[int, int, str]]:
+        """Every message after the given id that was sent after the given timestamp"""
+        await self.flush()
+        async with self.connection.execute(f"SELECT id, user_id, content FROM {DB_TABLE_MESSAGES} "
+                                           f"WHERE id > ? AND timestamp > ? ORDER BY id", [after_id, since]) as cursor:
+            async for row in cursor:
+                yield row
+
+    async def count_matches(self, phrase: str, user_id: Optional[int] = None) -> int:
+        """How many messages contain the phrase, from every user or only one"""
+        await self.flush()
+        if user_id is None:
+            query, params = f"SELECT COUNT(*) FROM {DB_TABLE_SEARCH} WHERE {DB_TABLE_SEARCH} MATCH ?", [search_phrase(phrase)]
+        else:
+            query, params = f"SELECT COUNT(*) FROM {DB_TABLE_SEARCH} JOIN {DB_TABLE_MESSAGES} ON id = {DB_TABLE_SEARCH}.rowid " \
+                            f"WHERE {DB_TABLE_SEARCH} MATCH ? AND user_id = ?", [search_phrase(phrase), user_id]
+        async with self.connection.execute(query, params) as cursor:
+            count, = await cursor.fetchone()
+        return count
+
+    async def top_matching_users(self, phrase: str, limit: int) -> List[Tuple[int, int]]:
+        """The users with the most messages containing the phrase, and how many"""
+        await self.flush()
+        async with self.connection.execute(f"SELECT user_id, COUNT(*) AS matches FROM {DB_TABLE_SEARCH} "
+                                           f"JOIN {DB_TABLE_MESSAGES} ON id = {DB_TABLE_SEARCH}.rowid "
+                                           f"WHERE {DB_TABLE_SEARCH} MATCH ? GROUP BY user_id ORDER BY matches DESC LIMIT ?",
+                                           [search_phrase(phrase), limit]) as cursor:
+            return list(await cursor.fetchall())
+
+    async def sample_matches(self, phrase: str, limit: int, user_id: Optional[int] = None) -> List[Tuple[int, str]]:
+        """The latest messages containing the phrase, as user ids and excerpts with the phrase in bold"""
+        await self.flush()
+        query = f"SELECT user_id, snippet({DB_TABLE_SEARCH}, 0, '**', '**', '…', 16) FROM {DB_TABLE_SEARCH} " \
+                f"JOIN {DB_TABLE_MESSAGES} ON id = {DB_TABLE_SEARCH}.rowid WHERE {DB_TABLE_SEARCH} MATCH ?"
+        params = [search_phrase(phrase)]
+        if user_id is not None:
+            query += " AND user_id = ?"
+            params.append(user_id)
+        async with self.connection.execute(query + f" ORDER BY {DB_TABLE_SEARCH}.rowid DESC LIMIT ?", params + [limit]) as cursor:
+            return list(await cursor.fetchall())
+
+    async def iterate_period(self, since: int, until: int) -> AsyncIterator[Tuple[int, int, str]]:
+        """Every message sent after one timestamp and up to another"""
+        await self.flush()
+        async with self.connection.execute(f"SELECT id, user_id, content FROM {DB_TABLE_MESSAGES} "
+                                           f"WHERE timestamp > ? AND timestamp <= ? ORDER BY id", [since, until]) as cursor:
+            async for row in cursor:
+                yield row
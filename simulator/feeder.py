@@ -0,0 +1,120 @@
+import time
+import asyncio
+import discord
+from datetime import datetime
+from dataclasses import dataclass
+from typing import Optional, Dict
+
+from simulator.constants import FEED_CONCURRENCY, FEED_QUEUE_SIZE, FEED_BATCH_SIZE, FEED_PROGRESS_INTERVAL, COMMIT_SIZE
+
+
+@dataclass
+class ChannelProgress:
+    channel: discord.TextChannel
+    messages: int = 0
+    position: Optional[datetime] = None
+    started: bool = False
+    done: bool = False
+
+    def __str__(self) -> str:
+        if self.done:
+            state = "done"
+        elif self.position:
+            state = f"at {self.position:%Y-%m-%d %H:%M}"
+        else:
+            state = "reading" if self.started else "waiting"
+        return f"#{self.channel.name}: {self.messages:,} messages, {state}"
+
+
+class HistoryFeeder:
+    """Reads the history of several channels at the same time, through a bounded queue,
+    while a single consumer adds the messages to the guild's simulator and queues them for the database."""
+
+    def __init__(self, simulator, checkpoints: Dict[discord.TextChannel, int]):
+        """Each channel is read starting after the message id given for it"""
+        self.simulator = simulator
+        self.checkpoints = {channel.id: message_id for channel, message_id in checkpoints.items()}
+        self.progress: Dict[int, ChannelProgress] = {channel.id: ChannelProgress(channel) for channel in checkpoints}
+        self.queue: asyncio.Queue[Optional[discord.Message]] = asyncio.Queue(maxsize=FEED_QUEUE_SIZE)
+        self.semaphore = asyncio.Semaphore(FEED_CONCURRENCY)
+        self.start_time = time.perf_counter()
+        self.added = 0
+        self.skipped = 0
+
+    async def run(self, status: discord.Message):
+        """Feeds every channel, editing the status message with the progress until it's done or interrupted"""
+        self.save_checkpoints()
+        crawling = asyncio.gather(*(self.crawl(progress) for progress in self.progress.values()))
+        consumer = asyncio.create_task(self.consume())
+        reporter = asyncio.create_task(self.report(status))
+        try:
+            await asyncio.wait([crawling, consumer], return_when=asyncio.FIRST_COMPLETED)
+            if consumer.done():  # it only stops early because of an error
+                consumer.result()
+            crawling.result()
+            await self.queue.put(None)
+            await consumer
+        finally:
+            for task in (crawling, consumer, reporter):
+                task.cancel()
+            self.save_checkpoints()
+            await self.simulator.db.flush()
+            await self.edit_status(status)
+
+    async def crawl(self, progress: ChannelProgress):
+        async with self.semaphore:
+            progress.started = True
+            after = discord.Object(id=self.checkpoints[progress.channel.id])
+            async for message in progress.channel.history(after=after, limit=None, oldest_first=True):
+                progress.position = message.created_at
+                if not message.author.bot:
+                    await self.queue.put(message)
+            progress.done = True
+
+    async def consume(self):
+        db = self.simulator.db
+        finished = False
+        while not finished:
+            batch = [await self.queue.get()]
+            while len(batch) < FEED_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if batch[-1] is None:
+                finished = True
+                batch.pop()
+            if not batch:
+                continue
+            # messages stored by an earlier feed or by on_message while this one runs
+            existing = await db.existing_ids([message.id for message in batch])
+            for message in batch:
+                # only the consumer advances checkpoints, so they never get ahead of the queued inserts
+                self.checkpoints[message.channel.id] = message.id
+                if message.id in existing:
+                    self.skipped += 1
+                    continue
+                content = self.simulator.format_message(message)
+                if self.simulator.learn(message.id, message.author.id, content):  # older messages are only stored
+                    db.insert(message.id, message.author.id, content)
+                    self.progress[message.channel.id].messages += 1
+                    self.added += 1
+                    if self.added % COMMIT_SIZE == 0:
+                        self.save_checkpoints()
+
+    def save_checkpoints(self):
+        for channel_id, message_id in self.checkpoints.items():
+            self.simulator.db.set_checkpoint(channel_id, message_id)
+
+    async def report(self, status: discord.Message):
+        while True:
+            await asyncio.sleep(FEED_PROGRESS_INTERVAL)
+            await self.edit_status(status)
+
+    async def edit_status(self, status: discord.Message):
+        elapsed = time.perf_counter() - self.start_time
+        lines = [f"Feeding: {self.added:,} messages in {elapsed:.0f} seconds ({self.added / max(1.0, elapsed):.0f}/s)"]
+        if self.skipped:
+            lines[0] += f", {self.skipped:,} already stored"
+        lines += [str(progress) for progress in self.progress.values()]
+        try:
+            await status.edit(content="```" + "\n".join(lines) + "```")
+        except discord.DiscordException:
+            pass
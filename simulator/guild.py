@@ -0,0 +1,441 @@
+import enum
+import time
+import random
+import asyncio
+import discord
+from array import array
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List, Tuple
+
+from simulator.constants import log, WEBHOOK_NAME, DB_FILE, SNAPSHOT_FILE, REBUILD_CHUNK_SIZE, \
+    WINDOW_DAYS, WINDOW_INTERVAL, GENERATION_BUFFER_SIZE, RATE_LIMIT_RETRIES, COMMENT_DELAY, CONVERSATION_DELAY, CONVERSATION_MIN, CONVERSATION_MAX
+from simulator.model import MarkovModel, tokenize, decode_tokens
+from simulator.database import MessageDatabase, snowflake_timestamp
+from simulator.snapshot import serialize_snapshot, write_snapshot, load_snapshot
+
+
+class Stage(enum.Enum):
+    NONE = enum.auto()
+    SETTING_UP = enum.auto()
+    READY = enum.auto()
+
+
+class GuildSimulator:
+    """The simulator of a single guild, with its own settings, database and model.
+    The model is only loaded while the guild is active and may be unloaded to save memory. Meanwhile, new messages
+    are still stored, and edits and deletions of older ones are recorded to be applied when it loads again."""
+
+    def __init__(self, cog, guild: discord.Guild):
+        self.cog = cog
+        self.guild = guild
+        self.path: Path = cog.guild_path(guild.id)
+        self.input_channels: List[discord.TextChannel] = []
+        self.output_channel: Optional[discord.TextChannel] = None
+        self.role: Optional[discord.Role] = None
+        self.webhook: Optional[discord.Webhook] = None
+        self.comment_chance = 1 / COMMENT_DELAY
+        self.conversation_chance = 1 / CONVERSATION_DELAY
+        self.window_days = WINDOW_DAYS
+        self.stage = Stage.NONE
+        self.running = True
+        self.model: Optional[MarkovModel] = None
+        self.last_message_id = 0
+        self.last_change_id = 0
+        self.window_start = 0  # the model only includes messages sent after this timestamp
+        self.dirty = False  # whether the model changed since its snapshot was saved
+        self.last_active = 0.0
+        self.lock = asyncio.Lock()  # held while loading and unloading the model
+        self.feeding_task: Optional[asyncio.Task] = None
+        self.db = MessageDatabase(self.path.joinpath(DB_FILE))
+        self.seconds = 0
+        self.conversation_left = 0
+        self.comment_due = False
+        # messages generated ahead of time, and the one waiting to be sent
+        self.generated: asyncio.Queue[Tuple[int, str]] = asyncio.Queue(maxsize=GENERATION_BUFFER_SIZE)
+        self.outgoing: asyncio.Queue[Tuple[int, str]] = asyncio.Queue(maxsize=1)
+        self.tasks: List[asyncio.Task] = []
+
+    @property
+    def feeding(self) -> bool:
+        return bool(self.feeding_task and not self.feeding_task.done())
+
+    def memory(self) -> int:
+        """Approximate bytes used by the model, 0 if it isn't loaded"""
+        return self.model.stats().size if self.model else 0
+
+    async def setup(self, settings: dict):
+        """Finds the configured role and channels, and the webhook to send messages with"""
+        self.stage = Stage.SETTING_UP
+        try:
+            self.comment_chance = 1 / settings['comment_delay']
+            self.conversation_chance = 1 / settings['conversation_delay']
+            self.window_days = settings['window_days']
+            self.role = self.guild.get_role(settings['participant_role_id'])
+            self.input_channels = [self.guild.get_channel(i) for i in settings['input_channel_ids']]
+            self.output_channel = self.guild.get_channel(settings['output_channel_id'])
+            if self.role is None:
+                raise KeyError("role")
+            if any(c is None for c in self.input_channels):
+                raise KeyError("input_channels")
+            if self.output_channel is None:
+                raise KeyError("output_channel")
+            webhooks = await self.output_channel.webhooks()
+            webhooks = [w for w in webhooks if w.user == self.cog.bot.user and w.name == WEBHOOK_NAME]
+            self.webhook = webhooks[0] if webhooks else await self.output_channel.create_webhook(name=WEBHOOK_NAME)
+            self.path.mkdir(parents=True, exist_ok=True)
+            await self.db.open()
+            self.stage = Stage.READY
+            if not self.tasks:
+                self.tasks = [asyncio.create_task(self.producer()), asyncio.create_task(self.sender()),
+                              asyncio.create_task(self.expirer())]
+        except Exception:
+            self.stage = Stage.NONE
+            raise
+
+    # Model lifetime
+
+    async def load(self) -> bool:
+        """Loads the model if it isn't loaded yet. Returns whether it had to be loaded."""
+        async with self.lock:
+            if self.model is not None:
+                return False
+            start = time.perf_counter()
+            replayed = await self.load_model()
+            log.info(f"Simulator model of guild {self.guild.id} loaded from {self.model.message_count} messages "
+                     f"in {time.perf_counter() - start:.1f}s, {replayed} of them read from the database")
+            return True
+
+    async def unload(self):
+        """Saves the model if it changed, and frees it"""
+        async with self.lock:
+            if self.model is None or self.feeding:
+                return
+            if self.dirty:
+                await self.save_snapshot()
+            self.model = None
+            log.info(f"Simulator model of guild {self.guild.id} unloaded")
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.feeding:
+            self.feeding_task.cancel()
+            await asyncio.wait([self.feeding_task], timeout=10)
+        elif self.model is not None and self.dirty:
+            await self.save_snapshot()
+        await self.db.close()
+
+    async def load_model(self) -> int:
+        """Loads the model from its snapshot, the changes recorded while it was unloaded, and the database rows newer than it,
+        then removes the messages that left its time window. Returns the number of rows and changes read."""
+        snapshot = await asyncio.to_thread(load_snapshot, self.path.joinpath(SNAPSHOT_FILE))
+        changes = await self.db.fetch_changes()
+        last_change_id = changes[-1][0] if changes else 0
+        window_start = self.current_window_start()
+        replayed = 0
+        if snapshot:
+            model, last_message_id, applied_change_id, snapshot_start = snapshot
+            for change_id, message_id, user_id, content, removed in changes:
+                # newer rows are read below, and older ones aren't in the model
+                if change_id > applied_change_id and message_id <= last_message_id and snowflake_timestamp(message_id) > snapshot_start:
+                    if removed:
+                        model.remove_message(user_id, content)
+                    else:
+                        model.add_message(user_id, content)
+                    replayed += 1
+            if window_start < snapshot_start:
+                log.info(f"Simulator window of guild {self.guild.id} grew and its model will be rebuilt")
+                snapshot = None
+            elif await self.db.count_messages(last_message_id, snapshot_start) != model.message_count:
+                log.info(f"Simulator snapshot of guild {self.guild.id} doesn't match the database and will be rebuilt")
+                snapshot = None
+        if snapshot:  # only the few messages received since it was saved, and those that aged out meanwhile
+            async for message_id, user_id, content in self.db.iterate_period(snapshot_start, window_start):
+                if message_id <= last_message_id:
+                    model.remove_message(user_id, content)
+                    replayed += 1
+            async for message_id, user_id, content in self.db.iterate_messages(last_message_id, window_start):
+                model.add_message(user_id, content)
+                last_message_id = message_id
+                replayed += 1
+        else:
+            model, last_message_id = MarkovModel(), 0
+            # messages stored with their token ids don't need to be tokenized again, only mapped to the model's ids
+            token_ids: Optional[array] = None
+            if await self.db.is_encoded():
+                self.db.prune_vocabulary()  # the rebuild reads the messages anyway
+                token_ids = array('I')
+
+            async def map_vocabulary():
+                for token_id, token in await self.db.fetch_vocabulary(len(token_ids)):
+                    token_ids.extend([0] * (token_id - len(token_ids)))  # removed tokens leave gaps
+                    token_ids.append(model.vocabulary.intern(token))
+
+            async def rows():
+                nonlocal last_message_id
+                messages = self.db.iterate_messages(0, window_start) if token_ids is None else self.db.iterate_encoded(window_start)
+                async for message_id, user_id, content in messages:
+                    last_message_id = message_id
+                    if token_ids is not None and max(decode_tokens(content)) >= len(token_ids):  # stored during the rebuild
+                        await map_vocabulary()
+                    yield user_id, content
+
+            if token_ids is not None:
+                await map_vocabulary()
+            # counting every message is too slow for the event loop, so it happens in other processes
+            processes = self.cog.rebuild_processes
+            replayed = await model.add_messages(rows(), self.cog.rebuild_executor(), REBUILD_CHUNK_SIZE, 2 * processes, token_ids)
+        self.model = model
+        self.last_message_id = last_message_id
+        self.last_change_id = last_change_id
+        self.window_start = window_start
+        self.dirty = bool(replayed)
+        if self.dirty:
+            await self.save_snapshot()
+        if changes and not self.dirty:
+            self.db.clear_changes(last_change_id)  # only once they're in the snapshot
+        return replayed
+
+    async def save_snapshot(self):
+        if self.model is None:
+            return
+        await self.db.flush()  # so that the snapshot matches the database
+        chunks = serialize_snapshot(self.model, self.last_message_id, self.last_change_id, self.window_start)
+        self.dirty = False
+        try:
+            await asyncio.to_thread(write_snapshot, self.path.joinpath(SNAPSHOT_FILE), chunks)
+        except OSError:
+            self.dirty = True
+            log.exception("Saving simulator snapshot")
+
+    async def prune(self, target_size: int) -> int:
+        """Prunes the model in a worker thread until it fits in target_size bytes. Returns the bytes reclaimed."""
+        async with self.lock:
+            if self.model is None:
+                return 0
+            start = time.perf_counter()
+            reclaimed = await asyncio.to_thread(self.model.prune, target_size)
+            if reclaimed:
+                self.dirty = True
+                self.clear_generated()
+                log.info(f"Simulator model of guild {self.guild.id} pruned by {reclaimed / 2 ** 20:.1f} MB "
+                         f"in {time.perf_counter() - start:.1f}s")
+            return reclaimed
+
+    def delete_snapshot(self):
+        self.path.joinpath(SNAPSHOT_FILE).unlink(missing_ok=True)
+
+    # Time window
+
+    def current_window_start(self) -> int:
+        """Timestamp after which messages belong in the model"""
+        if not self.window_days:
+            return 0
+        return int((datetime.now(timezone.utc) - timedelta(days=self.window_days)).timestamp() * 1000)
+
+    def in_window(self, message_id: int) -> bool:
+        return snowflake_timestamp(message_id) > self.window_start
+
+    async def expire_messages(self) -> int:
+        """Removes the messages that left the time window from the model, while the database keeps them.
+        Returns how many were removed."""
+        async with self.lock:
+            window_start = self.current_window_start()
+            if self.model is None or self.feeding or window_start <= self.window_start:
+                return 0
+            removed = 0
+            async for message_id, user_id, content in self.db.iterate_period(self.window_start, window_start):
+                if message_id <= self.last_message_id:
+                    self.remove_message(user_id, content)
+                    removed += 1
+                    if removed % 1000 == 0:
+                        await asyncio.sleep(0)
+            self.window_start = window_start
+            self.dirty = True
+            if removed:
+                log.info(f"Removed {removed} messages older than {self.window_days} days from the simulator model of guild {self.guild.id}")
+            return removed
+
+    async def set_window(self, days: int):
+        """Changes the time window. A wider one needs the model to be rebuilt with older messages, so it's unloaded."""
+        self.window_days = days
+        if self.model is None or self.feeding:
+            return
+        if self.current_window_start() < self.window_start:
+            await self.unload()
+        else:
+            await self.expire_messages()
+
+    async def expirer(self):
+        while True:
+            await asyncio.sleep(WINDOW_INTERVAL)
+            try:
+                await self.expire_messages()
+            except Exception:  # noqa, reason: it will try again later
+                log.exception(f"Removing old messages from simulator model of guild {self.guild.id}")
+
+    # Messages, which are stored whether the model is loaded or not
+
+    def is_input_channel(self, channel_id: int) -> bool:
+        return any(channel.id == channel_id for channel in self.input_channels)
+
+    def learn(self, message_id: int, user_id: int, content: str) -> bool:
+        """Adds a message to the model if it's loaded and the message is within its time window.
+        Returns whether there was anything to learn from it, which is when it's worth storing."""
+        if self.model is None or not self.in_window(message_id):
+            return bool(tokenize(content))
+        if not self.add_message(user_id, content):
+            return False
+        self.last_message_id = max(self.last_message_id, message_id)
+        return True
+
+    async def receive_message(self, message: discord.Message):
+        async with self.lock:
+            content = self.format_message(message)
+            if self.learn(message.id, message.author.id, content):
+                self.db.insert(message.id, message.author.id, content)
+
+    async def delete_messages(self, message_ids: List[int]):
+        """Removes stored messages from the database and the model, using the stored content"""
+        async with self.lock:
+            for message_id, user_id, content in await self.db.fetch_messages(message_ids):
+                self.remove_stored(message_id, user_id, content)
+                self.db.delete(message_id)
+
+    async def edit_message(self, edited: discord.Message):
+        async with self.lock:
+            rows = await self.db.fetch_messages([edited.id])
+            if rows:
+                _, user_id, content = rows[0]
+                if content == self.format_message(edited):
+                    return  # only the embeds changed
+                self.remove_stored(edited.id, user_id, content)
+                self.db.delete(edited.id)
+            content = self.format_message(edited)
+            if not self.learn(edited.id, edited.author.id, content):
+                return
+            if self.model is None:
+                self.db.record_change(edited.id, edited.author.id, content, removed=False)
+            self.db.insert(edited.id, edited.author.id, content)
+
+    def remove_stored(self, message_id: int, user_id: int, content: str):
+        if self.model is None:
+            self.db.record_change(message_id, user_id, content, removed=True)
+        elif self.in_window(message_id):
+            self.remove_message(user_id, content)
+
+    async def delete_user(self, user_id: int):
+        if not self.path.joinpath(DB_FILE).exists():
+            return
+        async with self.lock:
+            await self.db.open()
+            if self.model is not None:
+                self.model.remove_user(user_id)
+                self.dirty = True
+            self.db.delete_user(user_id)
+            self.clear_generated()
+            await self.db.flush()
+            if self.model is not None and not self.feeding:
+                await self.save_snapshot()
+            else:
+                self.delete_snapshot()
+
+    # Model functions
+
+    def add_message(self, user_id: Optional[int] = None, content: Optional[str] = None, message: Optional[discord.Message] = None) -> bool:
+        """Add a message to the model"""
+        if message:
+            user_id = message.author.id
+            content = self.format_message(message)
+        added = self.model.add_message(int(user_id), content)
+        self.dirty |= added
+        return added
+
+    def remove_message(self, user_id: int, content: str) -> bool:
+        """Remove a message from the model"""
+        removed = self.model.remove_message(int(user_id), content)
+        self.dirty |= removed
+        return removed
+
+    def start_conversation(self):
+        self.conversation_left = random.randrange(CONVERSATION_MIN, CONVERSATION_MAX + 1)
+
+    # Sending pipeline, so that neither generating nor a rate limit ever holds up the simulator loop
+
+    def queue_comment(self) -> bool:
+        """Hands a ready message to the sender without waiting. Returns False if there is none,
+        or if the sender is still busy with the previous one, in which case the comment should be tried again later."""
+        if self.generated.empty() or self.outgoing.full():
+            return False
+        self.outgoing.put_nowait(self.generated.get_nowait())
+        return True
+
+    def clear_generated(self):
+        """Discards the messages generated ahead of time, such as after a user is removed from the model"""
+        while not self.generated.empty():
+            self.generated.get_nowait()
+
+    async def producer(self):
+        """Keeps the buffer of generated messages full, generating in a worker thread"""
+        while True:
+            if self.model is None or not self.model.users or self.feeding:
+                await asyncio.sleep(1)
+                continue
+            # the lock keeps the model from changing or unloading while the thread reads it,
+            # and feeding, which changes it without the lock, only starts while holding it
+            async with self.lock:
+                if self.model is None or not self.model.users or self.feeding:
+                    continue
+                try:
+                    message = await asyncio.to_thread(self.generate_message)
+                except Exception:  # noqa, reason: a bad generation should not stop the producer
+                    log.exception(f"Generating simulator message in guild {self.guild.id}")
+                    await asyncio.sleep(1)
+                    continue
+            await self.generated.put(message)
+
+    async def sender(self):
+        """Sends the messages queued by the simulator loop one at a time, waiting out rate limits"""
+        while True:
+            user_id, content = await self.outgoing.get()
+            try:
+                await self.send_generated_message(user_id, content)
+            except Exception as error:  # noqa, reason: reported in the output channel
+                log.exception("Simulator loop")
+                try:
+                    await self.output_channel.send(f'{type(error).__name__}: {error}')
+                except discord.DiscordException:
+                    pass
+            finally:
+                self.outgoing.task_done()
+
+    async def send_generated_message(self, user_id: int, content: str):
+        user = self.guild.get_member(int(user_id))
+        if not user or not content or user.id in self.cog.blacklisted_users:
+            return
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                await self.webhook.send(username=user.display_name,
+                                        avatar_url=user.display_avatar.url,
+                                        content=content,
+                                        allowed_mentions=discord.AllowedMentions.none())
+                return
+            except discord.HTTPException as error:
+                # discord.py already waits out the webhook bucket, this is when it gives up
+                if error.status != 429 or attempt == RATE_LIMIT_RETRIES:
+                    raise
+                retry_after = float(error.response.headers.get('Retry-After', 1))
+                log.warning(f"Simulator webhook in guild {self.guild.id} rate limited for {retry_after:.1f}s")
+                await asyncio.sleep(retry_after)
+
+    def generate_message(self) -> Tuple[int, str]:
+        """Generate text based on the models"""
+        return self.model.generate_message()
+
+    @staticmethod
+    def format_message(message: discord.Message) -> str:
+        content = message.content
+        if message.attachments and message.attachments[0].url:
+            content += (' ' if content else '') + message.attachments[0].url
+        return content
@@ -0,0 +1,582 @@
+import re
+import sys
+import random
+import asyncio
+from array import array
+from collections import deque
+from concurrent.futures import Executor
+from itertools import accumulate
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Tuple, Union, Iterator, Iterable, Sequence, AsyncIterable
+
+from simulator.constants import CHAIN_END, TOKENIZER, SUBTOKENIZER
+
+START = 0  # id of the empty token that begins every chain
+END = 1    # id of CHAIN_END
+
+# Approximate memory used by the structures below, to keep track of it without measuring every object
+STATE_BYTES = 150      # array header, key and dictionary entry of a state
+TRANSITION_BYTES = 8   # token id and weight
+TOKEN_BYTES = 84       # list slot, dictionary entry, id and index entries of a token, besides the string itself
+
+# Partial model built by a worker process: its own token list, and for every user their number of messages
+# and flat arrays of their states, the number of transitions of each state, and the tokens and weights of those transitions.
+# Arrays are cheap to send between processes and don't create garbage for the collector.
+# The token list is None when the ids are those of the database.
+TransitionCounts = Tuple[Optional[List[str]], Dict[int, Tuple[int, array, array, array, array]]]
+
+
+def tokenize(content: Optional[str]) -> List[str]:
+    """Split a message into tokens, ending with CHAIN_END. Returns an empty list if there's nothing to learn."""
+    content = content.replace(CHAIN_END, '') if content else ''
+    if not content:
+        return []
+    tokens = []
+    for match in TOKENIZER.finditer(content):
+        token = match.group(1)
+        subtokens = [m.group(0) for m in SUBTOKENIZER.finditer(token)]
+        if subtokens and ''.join(subtokens) == token:  # treat special objects as 2 separate tokens, for better chains
+            tokens.extend(subtokens)
+        else:
+            tokens.append(token)
+    if not tokens:
+        return []
+    tokens.append(CHAIN_END)
+    return tokens
+
+
+def encode_tokens(token_ids: Iterable[int]) -> bytes:
+    """Pack the token ids of a message as stored in the database, little-endian and without the final CHAIN_END"""
+    token_ids = array('I', token_ids)
+    if sys.byteorder == "big":
+        token_ids.byteswap()
+    return token_ids.tobytes()
+
+
+def decode_tokens(blob: bytes) -> array:
+    """Unpack the token ids of a message stored in the database, adding back the final CHAIN_END"""
+    token_ids = array('I')
+    token_ids.frombytes(blob)
+    if sys.byteorder == "big":
+        token_ids.byteswap()
+    token_ids.append(END)
+    return token_ids
+
+
+def count_transitions(rows: List[Tuple[int, Optional[str]]]) -> TransitionCounts:
+    """Tokenize (user_id, content) rows into a partial model. Meant to run in a worker process."""
+    vocabulary = Vocabulary()
+    messages = ((user_id, [vocabulary.intern(token) for token in tokenize(content)]) for user_id, content in rows)
+    return vocabulary.tokens, _count_transitions(messages)
+
+
+def count_encoded_transitions(rows: List[Tuple[int, bytes]]) -> TransitionCounts:
+    """Count (user_id, tokens) rows as stored in the database into a partial model, without tokenizing them again.
+    They keep the token ids of the database. Meant to run in a worker process."""
+    return None, _count_transitions((user_id, decode_tokens(blob)) for user_id, blob in rows)
+
+
+def _count_transitions(messages: Iterable[Tuple[int, Sequence[int]]]) -> Dict[int, Tuple[int, array, array, array, array]]:
+    users: Dict[int, List] = {}
+    for user_id, tokens in messages:
+        if not tokens:
+            continue
+        user = users.get(user_id)
+        if user is None:
+            user = users[user_id] = [0, {}]
+        user[0] += 1
+        states = user[1]
+        previous = START
+        for token in tokens:
+            weights = states.get(previous)
+            if weights is None:
+                weights = states[previous] = {}
+            weights[token] = weights.get(token, 0) + 1
+            previous = token
+    result = {}
+    for user_id, (frequency, states) in users.items():
+        keys, sizes, tokens, weights = array('I', states.keys()), array('I'), array('I'), array('I')
+        for state in states.values():
+            sizes.append(len(state))
+            tokens.extend(state.keys())
+            weights.extend(state.values())
+        result[user_id] = frequency, keys, sizes, tokens, weights
+    return result
+
+
+def fix_formatting(result: str) -> str:
+    """Balance brackets, quotes and markdown in a generated message"""
+    if result.count('(') != result.count(')'):
+        result = re.sub(r"((?<=\w)[)]|[(](?=\w))", "", result)  # remove them and ignore smiley faces
+    for left, right in [('[', ']'), ('“', '”'), ('‘', '’'), ('«', '»')]:
+        if result.count(left) != result.count(right):
+            if result.count(left) > result.count(right) and not result.endswith(left):
+                result += right
+            else:
+                result = result.replace(left, '').replace(right, '')
+    for char in ['"', '||', '**', '__', '```', '`']:
+        if result.count(char) % 2 == 1:
+            if not result.endswith(char):
+                result += char
+            else:
+                result = result.replace(char, '')
+    return result
+
+
+@dataclass
+class ModelStats:
+    messages: int
+    nodes: int  # states and transitions
+    words: int  # tokens, counting every repetition
+    transitions: int
+    size: int  # bytes
+
+
+class Vocabulary:
+    """Token strings shared by every user model, which only store their integer ids.
+    It also indexes, for every token and across all users, how many times it appears and how many distinct tokens follow it.
+    A token is always followed by one transition, so its occurrences are the weights leaving its state."""
+    __slots__ = ("tokens", "ids", "size", "occurrences", "successors")
+
+    def __init__(self):
+        self.tokens: List[str] = ["", CHAIN_END]
+        self.ids: Dict[str, int] = {"": START, CHAIN_END: END}
+        self.size = sum(sys.getsizeof(token) + TOKEN_BYTES for token in self.tokens)
+        self.occurrences = array('Q', (0, 0))
+        self.successors = array('I', (0, 0))
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def intern(self, token: str) -> int:
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+            self.occurrences.append(0)
+            self.successors.append(0)
+            self.size += sys.getsizeof(token) + TOKEN_BYTES
+        return token_id
+
+    def get(self, token: str) -> Optional[int]:
+        return self.ids.get(token)
+
+    def measure(self) -> int:
+        """Exact size in bytes, by visiting every token"""
+        tokens, ids = list(self.tokens), list(self.ids.values())
+        return sys.getsizeof(self.tokens) + sys.getsizeof(self.ids) \
+            + sys.getsizeof(self.occurrences) + sys.getsizeof(self.successors) \
+            + sum(sys.getsizeof(token) for token in tokens) + sum(sys.getsizeof(token_id) for token_id in ids)
+
+
+@dataclass
+class UserModel:
+    """Transitions of a single user. Each state maps to one array of unsigned ints,
+    holding the sorted ids of the following tokens in its first half and their weights in its second half.
+    Cumulative weights of the states used for generation are cached in tables until the state changes.
+    The number of transitions and the sum of their weights are kept up to date, for statistics."""
+    user_id: int
+    frequency: int = 0
+    model: Dict[int, array] = field(default_factory=dict)
+    tables: Dict[int, array] = field(default_factory=dict, repr=False)
+    transitions: int = 0
+    words: int = 0
+
+    def add_transition(self, previous: int, token: int) -> int:
+        """Add a transition or increment its weight by 1. Returns its new weight."""
+        self.tables.pop(previous, None)
+        self.words += 1
+        state = self.model.get(previous)
+        if state is None:
+            self.model[previous] = array('I', (token, 1))
+            self.transitions += 1
+            return 1
+        size = len(state) // 2
+        i = bisect_left(state, token, 0, size)
+        if i < size and state[i] == token:
+            state[size + i] += 1
+            return state[size + i]
+        state.insert(size + i, 1)
+        state.insert(i, token)
+        self.transitions += 1
+        return 1
+
+    def add_transitions(self, previous: int, tokens: List[int], weights: array):
+        """Add the weights of several transitions from the same state"""
+        self.tables.pop(previous, None)
+        self.words += sum(weights)
+        state = self.model.get(previous)
+        if state is None:
+            order = sorted(range(len(tokens)), key=tokens.__getitem__)
+            state = self.model[previous] = array('I', [tokens[i] for i in order])
+            state.extend([weights[i] for i in order])
+            self.transitions += len(tokens)
+            return
+        size = len(state) // 2
+        for token, weight in zip(tokens, weights):
+            i = bisect_left(state, token, 0, size)
+            if i < size and state[i] == token:
+                state[size + i] += weight
+            else:
+                state.insert(size + i, weight)
+                state.insert(i, token)
+                size += 1
+                self.transitions += 1
+
+    def remove_transition(self, previous: int, token: int) -> Optional[int]:
+        """Decrement the weight of a transition by 1, deleting it and its state once they're empty.
+        Returns its new weight, or None if there was no such transition."""
+        state = self.model.get(previous)
+        if state is None:
+            return None
+        self.tables.pop(previous, None)
+        size = len(state) // 2
+        i = bisect_left(state, token, 0, size)
+        if i == size or state[i] != token:
+            return None
+        self.words -= 1
+        if state[size + i] > 1:
+            state[size + i] -= 1
+            return state[size + i]
+        self.transitions -= 1
+        if size == 1:
+            del self.model[previous]
+        else:
+            del state[size + i]
+            del state[i]
+        return 0
+
+    def next_token(self, previous: int) -> int:
+        """Pick a random token that follows the previous one, in O(log k)"""
+        state = self.model.get(previous)
+        if state is None:  # its transitions were pruned and then removed
+            return END
+        if len(state) == 2:
+            return state[0]
+        table = self.tables.get(previous)
+        if table is None:
+            table = self.tables[previous] = array('Q', accumulate(state[len(state) // 2:]))
+        return state[bisect_right(table, random.random() * table[-1])]
+
+    def successors(self, previous: int) -> array:
+        state = self.model.get(previous)
+        return state[:len(state) // 2] if state else array('I')
+
+    def weight(self, previous: int, token: int) -> int:
+        state = self.model.get(previous)
+        if not state:
+            return 0
+        size = len(state) // 2
+        i = bisect_left(state, token, 0, size)
+        return state[size + i] if i < size and state[i] == token else 0
+
+    def occurrences(self, token: int) -> int:
+        """How many times the token appears, in O(k)"""
+        if token == START:
+            return 0
+        if token == END:
+            return self.frequency
+        state = self.model.get(token)
+        return sum(state[len(state) // 2:]) if state else 0
+
+    def stats(self) -> ModelStats:
+        """Statistics from the counters, in O(1)"""
+        return ModelStats(self.frequency, len(self.model) + self.transitions, self.words, self.transitions,
+                          len(self.model) * STATE_BYTES + self.transitions * TRANSITION_BYTES)
+
+    def measure(self) -> ModelStats:
+        """Exact statistics, by visiting every state. Safe to run in another thread."""
+        states = list(self.model.items())
+        transitions = sum(len(state) // 2 for _, state in states)
+        words = sum(sum(state[len(state) // 2:]) for _, state in states)
+        size = sys.getsizeof(self.model) + sum(sys.getsizeof(key) + sys.getsizeof(state) for key, state in states)
+        return ModelStats(self.frequency, len(states) + transitions, words, transitions, size)
+
+    def recount(self):
+        """Sets the counters after the states were modified directly"""
+        stats = self.measure()
+        self.transitions, self.words = stats.transitions, stats.words
+
+    def prune(self, min_weight: int) -> List[Tuple[int, int, int]]:
+        """Remove the transitions with a weight up to min_weight, except for the one leading each state closest to the end,
+        then remove the states that can no longer be reached. Returns the state, transitions and weight removed from each state."""
+        model = self.model
+        if not any(len(state) > 2 and min(state[len(state) // 2:]) <= min_weight for state in model.values()):
+            return []
+        # distance from each state to the end, following the transitions backwards
+        predecessors: Dict[int, List[int]] = {}
+        for previous, state in model.items():
+            for token in state[:len(state) // 2]:
+                predecessors.setdefault(token, []).append(previous)
+        distance = {token: 0 for token in predecessors if token not in model}  # END, or states removed since the last pruning
+        queue = deque(distance)
+        while queue:
+            token = queue.popleft()
+            for previous in predecessors.get(token, ()):
+                if previous not in distance:
+                    distance[previous] = distance[token] + 1
+                    queue.append(previous)
+        del predecessors
+        removed = []
+        for previous, state in list(model.items()):
+            size = len(state) // 2
+            if size == 1 or min(state[size:]) > min_weight:
+                continue
+            exit_index = min(range(size), key=lambda i: (distance.get(state[i], len(model)), -state[size + i]))
+            kept = [i for i in range(size) if state[size + i] > min_weight or i == exit_index]
+            if len(kept) < size:
+                compacted = array('I', [state[i] for i in kept])
+                compacted.extend(state[size + i] for i in kept)
+                model[previous] = compacted
+                self.tables.pop(previous, None)
+                removed.append((previous, size - len(kept), sum(state[size:]) - sum(compacted[len(kept):])))
+        # every state still reaches the end through its kept transitions, but some may not be reached from the start
+        reached = {START}
+        queue = deque(reached)
+        while queue:
+            state = model.get(queue.popleft())
+            if state is not None:
+                for token in state[:len(state) // 2]:
+                    if token not in reached:
+                        reached.add(token)
+                        queue.append(token)
+        for previous in [previous for previous in model if previous not in reached]:
+            state = model.pop(previous)
+            self.tables.pop(previous, None)
+            removed.append((previous, len(state) // 2, sum(state[len(state) // 2:])))
+        self.transitions -= sum(transitions for _, transitions, _ in removed)
+        self.words -= sum(words for _, _, words in removed)
+        return removed
+
+
+class MarkovModel:
+    """Markov chains of every user, sharing one vocabulary."""
+
+    def __init__(self):
+        self.vocabulary = Vocabulary()
+        self.users: Dict[int, UserModel] = {}
+        self.message_count = 0
+        self.states = 0
+        self.transitions = 0
+        self.words = 0
+        self.pruned_size = 0  # bytes reclaimed by pruning since it was loaded
+        self.floor_size = 0  # size after pruning everything it could
+        self._user_ids: List[int] = []
+        self._user_table: Optional[array] = None
+
+    def add_message(self, user_id: int, content: Optional[str]) -> bool:
+        """Add a message to the model"""
+        tokens = tokenize(content)
+        if not tokens:
+            return False
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = UserModel(user_id)
+        user.frequency += 1
+        self._user_table = None
+        states, transitions = len(user.model), user.transitions
+        vocabulary = self.vocabulary
+        previous = START
+        for token in tokens:
+            token = vocabulary.intern(token)
+            if user.add_transition(previous, token) == 1:
+                vocabulary.successors[previous] += 1
+            vocabulary.occurrences[previous] += 1
+            previous = token
+        self.message_count += 1
+        self.states += len(user.model) - states
+        self.transitions += user.transitions - transitions
+        self.words += len(tokens)
+        return True
+
+    async def add_messages(self, rows: AsyncIterable[Tuple[int, Union[str, bytes, None]]], executor: Executor,
+                           chunk_size: int, max_pending: int, token_ids: Optional[Sequence[int]] = None) -> int:
+        """Add many (user_id, content) rows to the model, tokenizing chunks of them in the executor
+        while the event loop only merges their partial counts. Returns the number of messages added.
+        If token_ids is given, the rows hold token ids from the database, and it maps each of them to the model's vocabulary.
+        It may grow while the rows are read."""
+        counter = count_transitions if token_ids is None else count_encoded_transitions
+        loop = asyncio.get_running_loop()
+        pending = set()
+        added = 0
+
+        async def merge_finished(return_when: str):
+            nonlocal pending, added
+            finished, pending = await asyncio.wait(pending, return_when=return_when)
+            for future in finished:
+                counts = future.result()
+                for _ in self.merge(counts, token_ids=token_ids):
+                    await asyncio.sleep(0)
+                added += sum(user[0] for user in counts[1].values())
+
+        chunk = []
+        async for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                pending.add(loop.run_in_executor(executor, counter, chunk))
+                chunk = []
+                if len(pending) >= max_pending:
+                    await merge_finished(asyncio.FIRST_COMPLETED)
+        if chunk:
+            pending.add(loop.run_in_executor(executor, counter, chunk))
+        if pending:
+            await merge_finished(asyncio.ALL_COMPLETED)
+        return added
+
+    def merge(self, counts: TransitionCounts, step: int = 500, token_ids: Optional[Sequence[int]] = None) -> Iterator[None]:
+        """Add the partial model made by count_transitions, or by count_encoded_transitions
+        with token_ids mapping the ids of the database to the model's. It yields every few states,
+        so that the caller may do other work in between, and must be iterated until the end."""
+        vocabulary, users = counts
+        if vocabulary is not None:
+            token_ids = [self.vocabulary.intern(token) for token in vocabulary]
+        merged = 0
+        for user_id, (frequency, keys, sizes, tokens, weights) in users.items():
+            user = self.users.get(user_id)
+            if user is None:
+                user = self.users[user_id] = UserModel(user_id)
+            user.frequency += frequency
+            self.message_count += frequency
+            self._user_table = None
+            position = 0
+            for previous, size in zip(keys, sizes):
+                end = position + size
+                states, transitions, words = len(user.model), user.transitions, user.words
+                previous = token_ids[previous]
+                user.add_transitions(previous, [token_ids[token] for token in tokens[position:end]], weights[position:end])
+                self.states += len(user.model) - states
+                self.transitions += user.transitions - transitions
+                self.words += user.words - words
+                self.vocabulary.successors[previous] += user.transitions - transitions
+                self.vocabulary.occurrences[previous] += user.words - words
+                position = end
+                merged += 1
+                if merged % step == 0:
+                    yield
+
+    def remove_message(self, user_id: int, content: Optional[str]) -> bool:
+        """Remove a message that was previously added to the model"""
+        tokens = tokenize(content)
+        user = self.users.get(user_id)
+        if not tokens or user is None:
+            return False
+        states, transitions, words = len(user.model), user.transitions, user.words
+        vocabulary = self.vocabulary
+        previous = START
+        for token in tokens:
+            token = vocabulary.get(token)
+            if token is None:
+                break
+            weight = user.remove_transition(previous, token)
+            if weight is not None:
+                vocabulary.occurrences[previous] -= 1
+                if weight == 0:
+                    vocabulary.successors[previous] -= 1
+            previous = token
+        self.states += len(user.model) - states
+        self.transitions += user.transitions - transitions
+        self.words += user.words - words
+        user.frequency -= 1
+        self.message_count -= 1
+        self._user_table = None
+        if user.frequency <= 0:
+            self.remove_user(user_id)
+        return True
+
+    def remove_user(self, user_id: int):
+        user = self.users.pop(user_id, None)
+        if user is not None:
+            self.message_count -= user.frequency
+            self.states -= len(user.model)
+            self.transitions -= user.transitions
+            self.words -= user.words
+            self._user_table = None
+            for previous, state in user.model.items():
+                self.vocabulary.successors[previous] -= len(state) // 2
+                self.vocabulary.occurrences[previous] -= sum(state[len(state) // 2:])
+
+    def prune(self, target_size: int) -> int:
+        """Remove the least used transitions in ascending order of weight, one user at a time, until the model fits
+        in target_size bytes or only the transitions that lead to the end are left. Returns the bytes reclaimed."""
+        initial_size = self.stats().size
+        # only states with more than one transition can lose any
+        weights = sorted({weight for user in self.users.values() for state in user.model.values() if len(state) > 2
+                          for weight in state[len(state) // 2:]})
+        for min_weight in weights:
+            if self.stats().size <= target_size:
+                break
+            for user in self.users.values():
+                if self.stats().size <= target_size:
+                    break
+                states = len(user.model)
+                for previous, transitions, words in user.prune(min_weight):
+                    self.vocabulary.successors[previous] -= transitions
+                    self.vocabulary.occurrences[previous] -= words
+                    self.transitions -= transitions
+                    self.words -= words
+                self.states += len(user.model) - states
+        if self.stats().size > target_size:  # it can't get any smaller until more messages are added
+            self.floor_size = self.stats().size
+        reclaimed = initial_size - self.stats().size
+        self.pruned_size += reclaimed
+        return reclaimed
+
+    @property
+    def prunable(self) -> bool:
+        """Whether it grew since pruning last left it as small as it can be"""
+        return self.stats().size > self.floor_size
+
+    def occurrences(self, token: int) -> int:
+        """How many times the token appears across all users, in O(1)"""
+        if token == START:
+            return 0
+        return self.message_count if token == END else self.vocabulary.occurrences[token]
+
+    def successors(self, token: int) -> int:
+        """How many distinct tokens follow the token in each user's model, added up, in O(1)"""
+        return self.vocabulary.successors[token]
+
+    def stats(self) -> ModelStats:
+        """Statistics from the counters, in O(1)"""
+        return ModelStats(self.message_count, self.states + self.transitions, self.words, self.transitions,
+                          self.states * STATE_BYTES + self.transitions * TRANSITION_BYTES + self.vocabulary.size)
+
+    def measure(self) -> ModelStats:
+        """Exact statistics, by visiting every state. Safe to run in another thread."""
+        users = [user.measure() for user in list(self.users.values())]
+        return ModelStats(self.message_count, sum(user.nodes for user in users), sum(user.words for user in users),
+                          sum(user.transitions for user in users),
+                          sum(user.size for user in users) + sys.getsizeof(self.users) + self.vocabulary.measure())
+
+    def recount(self):
+        """Sets the counters and the token index after the users were modified directly"""
+        occurrences = self.vocabulary.occurrences = array('Q', bytes(8 * len(self.vocabulary)))
+        successors = self.vocabulary.successors = array('I', bytes(4 * len(self.vocabulary)))
+        for user in self.users.values():
+            user.recount()
+            for previous, state in user.model.items():
+                successors[previous] += len(state) // 2
+                occurrences[previous] += sum(state[len(state) // 2:])
+        self.states = sum(len(user.model) for user in self.users.values())
+        self.transitions = sum(user.transitions for user in self.users.values())
+        self.words = sum(user.words for user in self.users.values())
+
+    def pick_user(self) -> UserModel:
+        """Pick a random user weighted by how many messages they've sent"""
+        if self._user_table is None:
+            self._user_ids = list(self.users.keys())
+            self._user_table = array('Q', accumulate(user.frequency for user in self.users.values()))
+        user_id = self._user_ids[bisect_right(self._user_table, random.random() * self._user_table[-1])]
+        return self.users[user_id]
+
+    def generate_message(self) -> Tuple[int, str]:
+        """Generate text based on the models"""
+        user = self.pick_user()
+        result = []
+        token = user.next_token(START)
+        while token != END:
+            result.append(token)
+            token = user.next_token(token)
+        tokens = self.vocabulary.tokens
+        return user.user_id, fix_formatting("".join(tokens[t] for t in result).strip())
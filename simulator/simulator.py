@@ -1,96 +1,27 @@
 import os
 import re
-import sys
-import enum
 import json
+import time
+import heapq
+import multiprocessing
 import random
-import logging
 import asyncio
 import discord
-import aiosqlite as sql
 from pathlib import Path
-from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Tuple, Mapping, Set, Deque
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List, Dict, Set, Literal
 from discord.ext import tasks
 from redbot.core import commands, Config
 from redbot.core.bot import Red
 from redbot.core.data_manager import cog_data_path
 
-log = logging.getLogger("red.crab-cogs.simulator")
-
-WEBHOOK_NAME = "Simulator"
-DB_FILE = "messages.db"
-DB_TABLE_MESSAGES = "messages"
-COMMIT_SIZE = 1000
-
-CHAIN_END = "🔚"
-TOKENIZER = re.compile(
-    r"( ?https?://[^\s>]+"                # URLs
-    r"| ?<(@|#|@!|@&|a?:\w+:)\d{10,20}>"  # mentions, emojis
-    r"| ?@everyone| ?@here"               # pings
-    r"| ?[\w'-]+"                         # words
-    r"|[^\w<]+|<)"                        # symbols
-)
-SUBTOKENIZER = re.compile(
-    r"( ?https?://(?=[^\s>])|(?<=://)[^\s>]+"         # URLs
-    r"| ?<a?:(?=\w)|(?<=:)\w+:\d{10,20}>"             # emojis
-    r"| ?<[@#](?=[\d&!])|(?<=[@#])[!&]?\d{10,20}>)"   # mentions
-)
-
-COMMENT_DELAY = 5
-CONVERSATION_DELAY = 30
-CONVERSATION_MIN = 4
-CONVERSATION_MAX = 15
-
-EMOJI_LOADING = '⌛'
-EMOJI_SUCCESS = '✅'
-
-ERROR_CONFIG = "You must configure the simulator input role, input channels and output channel. They must be in the same guild."
-ERROR_SETUP = "Failed to set up the simulator. Make sure it is configured correctly and check your logs for errors."
-ERROR_FEEDING = "The simulator is currently feeding on past messages. Please wait a few minutes."
-ERROR_BOOTING = "The simulator is booting up. Wait a minute for it to finish."
-ERROR_CHANNELS = "A channel cannot be simulator input and output at the same time."
-
-
-def getsize(obj_0):
-    """Recursively iterate to sum size of object & members.
-    https://stackoverflow.com/a/30316760"""
-    _seen_ids = set()
-
-    def inner(obj):
-        obj_id = id(obj)
-        if obj_id in _seen_ids:
-            return 0
-        _seen_ids.add(obj_id)
-        size = sys.getsizeof(obj)
-        if isinstance(obj, (str, bytes, int, float, range, bytearray)):
-            pass  # bypass remaining control flow and return
-        elif isinstance(obj, (tuple, list, Set, Deque)):
-            size += sum(inner(i) for i in obj)
-        elif isinstance(obj, Mapping) or hasattr(obj, 'items'):
-            size += sum(inner(k) + inner(v) for k, v in getattr(obj, 'items')())
-        # Check for custom object instances - may subclass above too
-        if hasattr(obj, '__dict__'):
-            size += inner(vars(obj))
-        if hasattr(obj, '__slots__'):  # can have __slots__ with __dict__
-            size += sum(inner(getattr(obj, s)) for s in obj.__slots__ if hasattr(obj, s))
-        return size
-
-    return inner(obj_0)
-
-
-@dataclass
-class UserModel:
-    user_id: int
-    frequency: int
-    model: dict
-
-
-class Stage(enum.Enum):
-    NONE = enum.auto()
-    SETTING_UP = enum.auto()
-    READY = enum.auto()
+from simulator.constants import log, DB_FILE, SNAPSHOT_FILE, REBUILD_PROCESSES, COUNT_TOP_USERS, SEARCH_SAMPLES, MEMORY_BUDGET, WINDOW_DAYS, COMMENT_DELAY, CONVERSATION_DELAY, \
+    EMOJI_LOADING, EMOJI_SUCCESS, ERROR_CONFIG, ERROR_SETUP, ERROR_FEEDING, ERROR_BOOTING, ERROR_CHANNELS
+from simulator.model import MarkovModel
+from simulator.database import MessageDatabase
+from simulator.feeder import HistoryFeeder
+from simulator.guild import GuildSimulator, Stage
 
 
 class Simulator(commands.Cog):
@@ -102,45 +33,67 @@ class Simulator(commands.Cog):
         super().__init__()
         # Define variables
         self.bot = bot
-        self.guild: Optional[discord.Guild] = None
-        self.input_channels: List[discord.TextChannel] = []
-        self.output_channel: Optional[discord.TextChannel] = None
-        self.role: Optional[discord.Role] = None
-        self.webhook: Optional[discord.Webhook] = None
+        self.guilds: Dict[int, GuildSimulator] = {}
         self.blacklisted_users: List[int] = []
-        self.models: Dict[int, UserModel] = {}
-        self.comment_chance = 1 / COMMENT_DELAY
-        self.conversation_chance = 1 / CONVERSATION_DELAY
-        self.stage = Stage.NONE
-        self.feeding_task: Optional[asyncio.Task] = None
-        self.message_count = 0
+        self.memory_budget = MEMORY_BUDGET
+        self.loading_tasks: Set[asyncio.Task] = set()
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.rebuild_processes = max(1, min(REBUILD_PROCESSES, (os.cpu_count() or 1) - 1))
         self.seconds = 0
-        self.conversation_left = 0
         # Config
         self.config = Config.get_conf(self, identifier=7369756174)
         default_config = {
+            "blacklisted_users": [],
+            "memory_budget": MEMORY_BUDGET,
+            # settings of the single guild supported by older versions, only read to migrate them
             "home_guild_id": 0,
             "input_channel_ids": [0],
             "output_channel_id": 0,
             "participant_role_id": 0,
-            "blacklisted_users": [],
             "comment_delay": COMMENT_DELAY,
             "conversation_delay": CONVERSATION_DELAY,
         }
+        default_guild = {
+            "input_channel_ids": [],
+            "output_channel_id": 0,
+            "participant_role_id": 0,
+            "comment_delay": COMMENT_DELAY,
+            "conversation_delay": CONVERSATION_DELAY,
+            "window_days": WINDOW_DAYS,
+        }
         self.config.register_global(**default_config)
+        self.config.register_guild(**default_guild)
         # Start simulator if possible
         self.simulator_loop.start()
 
     async def cog_unload(self):
         self.simulator_loop.stop()
-        if self.feeding_task and not self.feeding_task.done():
-            self.feeding_task.cancel()
+        for task in self.loading_tasks:
+            task.cancel()
+        for simulator in self.guilds.values():
+            await simulator.close()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)  # don't block the event loop on running chunks
+
+    def rebuild_executor(self) -> ProcessPoolExecutor:
+        """Process pool shared by every model rebuild, started the first time it's needed"""
+        if self.executor is None:
+            # forking the bot while it runs threads (database, to_thread) can deadlock the child processes
+            context = multiprocessing.get_context("spawn")
+            self.executor = ProcessPoolExecutor(self.rebuild_processes, mp_context=context)
+        return self.executor
 
     async def red_delete_data_for_user(self, requester: str, user_id: int):
-        self.models.pop(user_id, None)
-        async with sql.connect(cog_data_path(self).joinpath(DB_FILE)) as db:
-            await db.execute(f"DELETE FROM {DB_TABLE_MESSAGES} WHERE user_id = ?", [user_id])
-            await db.commit()
+        for simulator in self.guilds.values():
+            await simulator.delete_user(user_id)
+        # guilds whose simulator isn't set up still have their data on disk
+        for path in cog_data_path(self).iterdir():
+            if path.is_dir() and path.name.isdigit() and int(path.name) not in self.guilds and path.joinpath(DB_FILE).exists():
+                db = MessageDatabase(path.joinpath(DB_FILE))
+                await db.open()
+                db.delete_user(user_id)
+                await db.close()
+                path.joinpath(SNAPSHOT_FILE).unlink(missing_ok=True)
 
     # Commands
 
@@ -164,124 +117,195 @@ class Simulator(commands.Cog):
         await ctx.send(embed=embed)
 
     @simulator.command(name="stats")
-    async def simulator_stats(self, ctx: commands.Context, user: Optional[discord.Member] = None):
-        """Statistics about the simulator, globally or for a user"""
-        if not await self.check_participant(ctx):
+    @commands.guild_only()
+    async def simulator_stats(self, ctx: commands.Context, user: Optional[discord.Member] = None, exact: Optional[Literal["--exact"]] = None):
+        """Statistics about the simulator, globally or for a user. The bot owner may add --exact to measure everything."""
+        simulator = await self.check_participant(ctx)
+        if not simulator:
             return
-        await ctx.typing()
-
-        def count_nodes(tree: dict) -> int:
-            count = 0
-            for node in tree.values():
-                if isinstance(node, dict):
-                    count += count_nodes(node) + 1
-                else:
-                    count += 1
-            return count
-
-        def count_words(tree: dict) -> int:
-            count = 0
-            for node in tree.values():
-                if isinstance(node, dict):
-                    count += count_words(node)
-                elif isinstance(node, int):
-                    count += node
-            return count
-
         if user:
-            if user.id not in self.models:
+            if user.id not in simulator.model.users:
                 await ctx.send("No data found for this user.")
                 return
-            messages = self.models[user.id].frequency
-            nodes = count_nodes(self.models[user.id].model)
-            words = count_words(self.models[user.id].model)
-            modelsize = getsize(self.models[user.id]) / 2 ** 20
-            filesize = None
+            model = simulator.model.users[user.id]
+        else:
+            model = simulator.model
+        if exact:
+            if not await self.bot.is_owner(ctx.author):
+                await ctx.send("Only the bot owner can measure exact statistics.")
+                return
+            await ctx.typing()
+            stats = await asyncio.to_thread(model.measure)
         else:
-            messages = self.message_count
-            nodes = sum(count_nodes(x.model) for x in self.models.values())
-            words = sum(count_words(x.model) for x in self.models.values())
-            modelsize = getsize(self.models) / 2 ** 20
-            filesize = os.path.getsize(cog_data_path(self).joinpath(DB_FILE)) / 2 ** 20
+            stats = model.stats()
+        filesize = None if user else os.path.getsize(simulator.path.joinpath(DB_FILE)) / 2 ** 20
 
         embed = discord.Embed(title="Simulator Stats", color=await ctx.embed_color())
-        embed.add_field(name="Messages", value=f"{messages:,}", inline=True)
-        embed.add_field(name="Nodes", value=f"{nodes:,}", inline=True)
-        embed.add_field(name="Words", value=f"{words:,}", inline=True)
-        embed.add_field(name="Memory", value=f"{round(modelsize, 2)} MB", inline=True)
+        embed.add_field(name="Messages", value=f"{stats.messages:,}", inline=True)
+        embed.add_field(name="Nodes", value=f"{stats.nodes:,}", inline=True)
+        embed.add_field(name="Words", value=f"{stats.words:,}", inline=True)
+        embed.add_field(name="Transitions", value=f"{stats.transitions:,}", inline=True)
+        embed.add_field(name="Memory", value=f"{'' if exact else '~'}{round(stats.size / 2 ** 20, 2)} MB", inline=True)
         if filesize:
             embed.add_field(name="Database", value=f"{round(filesize, 2)} MB", inline=True)
+        if not user and simulator.model.pruned_size:
+            embed.add_field(name="Pruned", value=f"~{round(simulator.model.pruned_size / 2 ** 20, 2)} MB reclaimed", inline=True)
         await ctx.send(embed=embed)
 
     @simulator.command(name="count")
+    @commands.guild_only()
     async def simulator_count(self, ctx: commands.Context, word: str, user: Optional[discord.Member] = None):
         """Count instances of a word, globally or for a user"""
-        if not await self.check_participant(ctx):
+        simulator = await self.check_participant(ctx)
+        if not simulator:
             return
-        sword = ' ' + word
+        word_ids = [i for i in (simulator.model.vocabulary.get(word), simulator.model.vocabulary.get(' ' + word)) if i is not None]
         if user:
-            if user.id not in self.models:
+            if user.id not in simulator.model.users:
                 await ctx.send("No data found for this user.")
                 return
-            occurences = sum(x.get(word, 0) + x.get(sword, 0) for x in self.models[user.id].model.values())
-            children = len(self.models[user.id].model.get(word, {}) | self.models[user.id].model.get(sword, {}))
-        else:
-            occurences = sum(sum(x.get(word, 0) + x.get(sword, 0) for x in m.model.values())
-                             for m in self.models.values())
-            children = sum(len(m.model.get(word, {}) | m.model.get(sword, {})) for m in self.models.values())
-        await ctx.send(f"```yaml\nOccurrences: {occurences:,}\nWords that follow: {children:,}```")
+            model = simulator.model.users[user.id]
+            occurrences = sum(model.occurrences(i) for i in word_ids)
+            children = len(set().union(*(model.successors(i) for i in word_ids)))
+            await ctx.send(f"```yaml\nOccurrences: {occurrences:,}\nWords that follow: {children:,}```")
+            return
+        occurrences = sum(simulator.model.occurrences(i) for i in word_ids)
+        children = sum(simulator.model.successors(i) for i in word_ids)
+        lines = [f"Occurrences: {occurrences:,}", f"Words that follow: {children:,}"]
+        if occurrences:
+            counts = ((sum(model.occurrences(i) for i in word_ids), user_id) for user_id, model in simulator.model.users.items())
+            top = [(count, user_id) for count, user_id in heapq.nlargest(COUNT_TOP_USERS, counts) if count]
+            lines.append("Top users:")
+            for count, user_id in top:
+                member = ctx.guild.get_member(user_id)
+                lines.append(f"  {member.display_name if member else user_id}: {count:,}")
+        await ctx.send("```yaml\n" + "\n".join(lines) + "```")
+
+    @simulator.command(name="search")
+    @commands.guild_only()
+    async def simulator_search(self, ctx: commands.Context, phrase: str, user: Optional[discord.Member] = None):
+        """Search every stored message for a word or phrase, globally or for a user. Use quotes for several words."""
+        simulator = await self.check_participant(ctx, load=False)
+        if not simulator:
+            return
+        await ctx.typing()
+        matches = await simulator.db.count_matches(phrase, user.id if user else None)
+        embed = discord.Embed(title="Simulator Search", color=await ctx.embed_color())
+        embed.description = f"{matches:,} messages contain \"{discord.utils.escape_markdown(phrase)}\""
+        if not simulator.db.search_backfilled:
+            embed.description += " so far, older messages are still being indexed"
+        if matches and not user:
+            lines = []
+            for user_id, count in await simulator.db.top_matching_users(phrase, COUNT_TOP_USERS):
+                member = ctx.guild.get_member(user_id)
+                lines.append(f"{member.mention if member else user_id}: {count:,}")
+            embed.add_field(name="Top users", value="\n".join(lines), inline=False)
+        if matches:
+            lines = []
+            for user_id, excerpt in await simulator.db.sample_matches(phrase, SEARCH_SAMPLES, user.id if user else None):
+                member = ctx.guild.get_member(user_id)
+                excerpt = excerpt.replace("\n", " ")
+                lines.append(f"> {excerpt}\n— {member.mention if member else user_id}")
+            embed.add_field(name="Latest", value="\n".join(lines)[:1024], inline=False)
+        await ctx.send(embed=embed, allowed_mentions=discord.AllowedMentions.none())
 
     @simulator.command(name="start")
     @commands.is_owner()
+    @commands.guild_only()
     @commands.bot_has_permissions(manage_webhooks=True)
     async def simulator_start(self, ctx: commands.Context):
         """Start the simulator in the configured channel."""
-        if self.feeding_task and not self.feeding_task.done():
+        simulator = self.get_simulator(ctx.guild)
+        if simulator.feeding:
             await ctx.send(ERROR_FEEDING)
             return
-        if not self.simulator_loop.is_running():
-            if not self.is_configured(await self.config.get_raw()):
+        if simulator.stage == Stage.SETTING_UP:
+            await ctx.send(ERROR_BOOTING)
+            return
+        if simulator.stage == Stage.NONE:
+            if not self.is_configured(await self.config.guild(ctx.guild).all()):
                 await ctx.send(ERROR_CONFIG)
                 return
-            if self.stage == Stage.NONE and not await self.setup_simulator():
+            if not await self.setup_guild(simulator):
                 await ctx.send(ERROR_SETUP)
                 return
-            self.simulator_loop.start()
-        self.start_conversation()
+        simulator.running = True
+        self.start_conversation(simulator)
         await ctx.message.add_reaction(EMOJI_SUCCESS)
 
     @simulator.command(name="stop")
     @commands.is_owner()
+    @commands.guild_only()
     async def simulator_stop(self, ctx: commands.Context):
         """Stop the simulator."""
-        self.simulator_loop.stop()
+        simulator = self.guilds.get(ctx.guild.id)
+        if simulator:
+            simulator.running = False
+            simulator.conversation_left = 0
         await ctx.message.add_reaction(EMOJI_SUCCESS)
 
-    @simulator.command(name="feed")
+    @simulator.group(name="feed", invoke_without_command=True)
     @commands.is_owner()
+    @commands.guild_only()
     async def simulator_feed(self, ctx: commands.Context, days: Optional[int] = None):
         """Feed past messages into the simulator from the configured channels from scratch."""
-        if self.feeding_task and not self.feeding_task.done():
-            self.feeding_task.cancel()
-            return
-        if self.stage == Stage.NONE and not await self.setup_simulator():
-            await ctx.send(ERROR_SETUP)
-            return
-        if self.stage == Stage.SETTING_UP:
-            await ctx.send(ERROR_BOOTING)
+        simulator = await self.prepare_feeding(ctx)
+        if not simulator:
             return
         if days is None or days < 0:
             await ctx.send_help()
             return
+        async with simulator.lock:
+            simulator.model = MarkovModel()
+            simulator.last_message_id = 0
+            simulator.window_start = simulator.current_window_start()
+            simulator.delete_snapshot()
+        simulator.last_active = time.monotonic()
+        after = discord.utils.time_snowflake(datetime.now(timezone.utc) - timedelta(days=days))
+        await self.start_feeding(ctx, simulator, {channel: after for channel in simulator.input_channels}, resume=False)
+
+    @simulator_feed.command(name="resume")
+    @commands.is_owner()
+    @commands.guild_only()
+    async def simulator_feed_resume(self, ctx: commands.Context):
+        """Continue an interrupted feed from where each channel was left, keeping the messages already stored."""
+        simulator = await self.prepare_feeding(ctx)
+        if not simulator:
+            return
+        stored = await simulator.db.fetch_checkpoints()
+        checkpoints = {channel: stored[channel.id] for channel in simulator.input_channels if channel.id in stored}
+        if not checkpoints:
+            await ctx.send(f"There is no feed to resume. Use `{ctx.prefix}simulator feed <days>` first.")
+            return
+        await self.activate(simulator)
+        await self.start_feeding(ctx, simulator, checkpoints, resume=True)
+
+    async def prepare_feeding(self, ctx: commands.Context) -> Optional[GuildSimulator]:
+        simulator = self.get_simulator(ctx.guild)
+        if simulator.feeding:
+            simulator.feeding_task.cancel()
+            return None
+        if simulator.stage == Stage.NONE and not await self.setup_guild(simulator):
+            await ctx.send(ERROR_SETUP)
+            return None
+        if simulator.stage == Stage.SETTING_UP:
+            await ctx.send(ERROR_BOOTING)
+            return None
+        return simulator
+
+    async def start_feeding(self, ctx: commands.Context, simulator: GuildSimulator, checkpoints: Dict[discord.TextChannel, int], resume: bool):
         await ctx.message.add_reaction(EMOJI_LOADING)
-        self.simulator_loop.stop()
-        self.message_count = 0
-        for user in self.models.values():
-            user.model = {}
-            user.frequency = 0
-        self.feeding_task = asyncio.create_task(self.feeder(ctx, days))
-        await ctx.send("```Started feeding. This may take 1 minute per 5000 messages, so be patient!\n"
-                       "When the process is finished or interrupted, the summary will be sent in this channel.```")
+        simulator.conversation_left = 0
+        skipped = [channel for channel in simulator.input_channels if channel not in checkpoints]
+        text = "Resumed feeding." if resume else "Started feeding."
+        text += " This may take a while, so be patient! This message will show the progress.\n" \
+                "When the process is finished or interrupted, the summary will be sent in this channel."
+        if skipped:
+            text += "\nNot fed before, skipping: " + ", ".join(f"#{channel.name}" for channel in skipped)
+        status = await ctx.send(f"```{text}```")
+        async with simulator.lock:  # waits for any message being generated from the model
+            simulator.clear_generated()
+            simulator.feeding_task = asyncio.create_task(self.feeder(ctx, simulator, status, checkpoints, resume))
 
     @commands.command()
     async def dontsimulateme(self, ctx: commands.Context):
@@ -306,62 +330,96 @@ class Simulator(commands.Cog):
         await ctx.send_help()
 
     @simulator_set.command(name="showsettings")
+    @commands.guild_only()
     async def simulator_set_showsettings(self, ctx: commands.Context):
         """Show the current simulator settings"""
+        simulator = self.get_simulator(ctx.guild)
         embed = discord.Embed(title="Simulator Settings", color=await ctx.embed_color())
-        embed.add_field(name="Input Role", value=self.role.mention if self.role else "None", inline=True)
-        embed.add_field(name="Input Channels", value=' '.join(ch.mention if ch else '' for ch in self.input_channels) or "None", inline=True)
-        embed.add_field(name="Output Channel", value=self.output_channel.mention if self.output_channel else "None", inline=True)
-        embed.add_field(name="Time between conversations", value=f"~{round(1 / self.conversation_chance)} minutes", inline=True)
-        embed.add_field(name="Time between comments", value=f"~{round(1 / self.comment_chance)} seconds", inline=True)
+        embed.add_field(name="Input Role", value=simulator.role.mention if simulator.role else "None", inline=True)
+        embed.add_field(name="Input Channels", value=' '.join(ch.mention if ch else '' for ch in simulator.input_channels) or "None", inline=True)
+        embed.add_field(name="Output Channel", value=simulator.output_channel.mention if simulator.output_channel else "None", inline=True)
+        embed.add_field(name="Time between conversations", value=f"~{round(1 / simulator.conversation_chance)} minutes", inline=True)
+        embed.add_field(name="Time between comments", value=f"~{round(1 / simulator.comment_chance)} seconds", inline=True)
+        embed.add_field(name="Time window", value=f"{simulator.window_days} days" if simulator.window_days else "None", inline=True)
+        embed.add_field(name="Memory budget", value=f"{self.memory_budget} MB" if self.memory_budget else "None", inline=True)
         await ctx.send(embed=embed)
 
     @simulator_set.command(name="inputchannels")
     @commands.is_owner()
+    @commands.guild_only()
     async def simulator_set_inputchannels(self, ctx: commands.Context, *channels: discord.TextChannel):
         """Set a series of channels that will feed the simulator."""
-        if self.output_channel and self.output_channel in channels:
+        simulator = self.get_simulator(ctx.guild)
+        if simulator.output_channel and simulator.output_channel in channels:
             await ctx.send(ERROR_CHANNELS)
             return
-        await self.config.home_guild_id.set(ctx.guild.id)
-        await self.config.input_channel_ids.set([channel.id for channel in channels])
-        self.guild = ctx.guild
-        self.input_channels = channels
+        await self.config.guild(ctx.guild).input_channel_ids.set([channel.id for channel in channels])
+        simulator.input_channels = list(channels)
         await ctx.react_quietly(EMOJI_SUCCESS)
 
     @simulator_set.command(name="outputchannel")
     @commands.is_owner()
+    @commands.guild_only()
     async def simulator_set_outputchannel(self, ctx: commands.Context, channel: discord.TextChannel):
         """Set the channel the simulator will run in."""
-        if channel in self.input_channels:
+        simulator = self.get_simulator(ctx.guild)
+        if channel in simulator.input_channels:
             await ctx.send(ERROR_CHANNELS)
             return
-        await self.config.output_channel_id.set(channel.id)
-        self.output_channel = channel
+        await self.config.guild(ctx.guild).output_channel_id.set(channel.id)
+        simulator.output_channel = channel
         await ctx.react_quietly(EMOJI_SUCCESS)
 
     @simulator_set.command(name="inputrole")
     @commands.is_owner()
+    @commands.guild_only()
     async def simulator_set_inputrole(self, ctx: commands.Context, role: discord.Role):
         """Members must have this role to participate in the simulator."""
-        await self.config.participant_role_id.set(role.id)
-        self.role = role
+        await self.config.guild(ctx.guild).participant_role_id.set(role.id)
+        self.get_simulator(ctx.guild).role = role
         await ctx.react_quietly(EMOJI_SUCCESS)
 
     @simulator_set.command(name="conversationdelay")
     @commands.is_owner()
+    @commands.guild_only()
     async def simulator_set_conversationdelay(self, ctx: commands.Context, minutes: int):
         """Simulated conversations will occur randomly according to this value in minutes."""
-        await self.config.conversation_delay.set(max(1, minutes))
-        self.conversation_chance = 1 / max(1, minutes)
+        await self.config.guild(ctx.guild).conversation_delay.set(max(1, minutes))
+        self.get_simulator(ctx.guild).conversation_chance = 1 / max(1, minutes)
         await ctx.react_quietly(EMOJI_SUCCESS)
 
     @simulator_set.command(name="commentdelay")
     @commands.is_owner()
+    @commands.guild_only()
     async def simulator_set_commentdelay(self, ctx: commands.Context, chance: int):
         """Messages will be sent randomly during simulated conversations according to this value in seconds."""
-        await self.config.comment_delay.set(max(1, chance))
-        self.comment_chance = 1 / max(1, chance)
+        await self.config.guild(ctx.guild).comment_delay.set(max(1, chance))
+        self.get_simulator(ctx.guild).comment_chance = 1 / max(1, chance)
+        await ctx.react_quietly(EMOJI_SUCCESS)
+
+    @simulator_set.command(name="window")
+    @commands.is_owner()
+    @commands.guild_only()
+    async def simulator_set_window(self, ctx: commands.Context, days: int):
+        """Only messages from this many past days will be simulated, while older ones stay stored. 0 for all of them."""
+        days = max(0, days)
+        await self.config.guild(ctx.guild).window_days.set(days)
+        simulator = self.get_simulator(ctx.guild)
+        loaded = simulator.model is not None
+        await ctx.typing()
+        await simulator.set_window(days)
+        if loaded and simulator.model is None:  # rebuilt with the older messages
+            await self.activate(simulator)
+        await ctx.react_quietly(EMOJI_SUCCESS)
+
+    @simulator_set.command(name="memorybudget")
+    @commands.is_owner()
+    async def simulator_set_memorybudget(self, ctx: commands.Context, megabytes: int):
+        """Models of the least recently active servers will be unloaded to stay under this many MB. 0 for no limit.
+        If the active ones are still too big, their rarest transitions are pruned until they fit."""
+        self.memory_budget = max(0, megabytes)
+        await self.config.memory_budget.set(self.memory_budget)
+        await self.enforce_memory_budget()
         await ctx.react_quietly(EMOJI_SUCCESS)
 
     # Listeners
@@ -371,163 +429,167 @@ class Simulator(commands.Cog):
         """Processes new incoming messages"""
         if not self.is_valid_event_message(message):
             return
-        if self.is_valid_input_message(message):
+        simulator = self.guilds.get(message.guild.id)
+        if not simulator or simulator.stage != Stage.READY:
+            return
+        if self.is_valid_input_message(simulator, message):
             if not await self.is_valid_red_message(message):
                 return
-            if self.add_message(message=message):
-                async with sql.connect(cog_data_path(self).joinpath(DB_FILE)) as db:
-                    await self.insert_message_db(message, db)
-                    await db.commit()
-        elif message.channel == self.output_channel:
+            await simulator.receive_message(message)
+        elif message.channel == simulator.output_channel:
             if not await self.is_valid_red_message(message):
                 return
             try:
                 await message.delete()
             except discord.DiscordException:
                 pass
-            if self.role in message.author.roles:
-                self.start_conversation()
+            if simulator.running and simulator.role in message.author.roles:
+                self.start_conversation(simulator)
 
     @commands.Cog.listener()
-    async def on_message_delete(self, message: discord.Message):
-        """Processes deleted messages"""
-        if not self.is_valid_event_message(message):
-            return
-        if not self.is_valid_input_message(message):
-            return
-        if not await self.is_valid_red_message(message):
-            return
-        async with sql.connect(cog_data_path(self).joinpath(DB_FILE)) as db:
-            await self.delete_message_db(message, db)
-            await db.commit()
-        self.message_count -= 1
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        """Processes deleted messages, even if they're not in the cache"""
+        await self.remove_messages(payload.guild_id, payload.channel_id, [payload.message_id])
 
     @commands.Cog.listener()
-    async def on_message_edit(self, message: discord.Message, edited: discord.Message):
-        """Processes edited messages"""
-        if not self.is_valid_event_message(message):
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        """Processes deleted messages, even if they're not in the cache"""
+        await self.remove_messages(payload.guild_id, payload.channel_id, list(payload.message_ids))
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        """Processes edited messages, even if they're not in the cache"""
+        edited = payload.message
+        if not self.is_valid_event_message(edited):
             return
-        if not self.is_valid_input_message(message):
+        simulator = self.guilds.get(edited.guild.id)
+        if not simulator or simulator.stage != Stage.READY:
             return
-        if not await self.is_valid_red_message(message):
+        if not self.is_valid_input_message(simulator, edited):
             return
-        async with sql.connect(cog_data_path(self).joinpath(DB_FILE)) as db:
-            await self.delete_message_db(message, db)
-            await db.commit()
-            if self.add_message(message=edited):
-                await self.insert_message_db(edited, db)
-                await db.commit()
+        if not await self.is_valid_red_message(edited):
+            return
+        await simulator.edit_message(edited)
 
     # Loop
 
     @tasks.loop(seconds=1, reconnect=True)
     async def simulator_loop(self):
-        if self.conversation_left:
-            if random.random() < self.comment_chance:
-                try:
-                    self.conversation_left -= 1
-                    await self.send_generated_message()
-                except Exception as error:
-                    log.exception("Simulator loop")
-                    try:
-                        await self.output_channel.send(f'{type(error).__name__}: {error}')
-                    except discord.DiscordException:
-                        pass
-        else:
-            self.seconds = (self.seconds + 1) % 60
-            if self.seconds == 0 and random.random() < self.conversation_chance:
-                self.start_conversation()
+        self.seconds = (self.seconds + 1) % 60
+        if self.seconds == 0:
+            await self.enforce_memory_budget()
+        for simulator in list(self.guilds.values()):
+            if simulator.stage != Stage.READY or not simulator.running or simulator.feeding:
+                continue
+            if simulator.conversation_left:
+                if simulator.model is None:  # still loading
+                    continue
+                # a comment that couldn't be queued yet is sent as soon as possible instead of being rolled again
+                simulator.comment_due = simulator.comment_due or random.random() < simulator.comment_chance
+                if simulator.comment_due and simulator.queue_comment():
+                    simulator.comment_due = False
+                    simulator.conversation_left -= 1
+            else:
+                simulator.seconds = (simulator.seconds + 1) % 60
+                if simulator.seconds == 0 and random.random() < simulator.conversation_chance:
+                    self.start_conversation(simulator)
 
     @simulator_loop.before_loop
-    async def setup_simulator(self) -> bool:
-        self.stage = Stage.SETTING_UP
+    async def setup_simulators(self):
+        await self.bot.wait_until_red_ready()
+        await self.migrate_config()
+        self.blacklisted_users = await self.config.blacklisted_users()
+        self.memory_budget = await self.config.memory_budget()
+        for guild_id, settings in (await self.config.all_guilds()).items():
+            guild = self.bot.get_guild(guild_id)
+            if guild and self.is_configured(settings):
+                await self.setup_guild(self.get_simulator(guild), settings)
+
+    async def migrate_config(self):
+        """Moves the settings and data of the single guild supported by older versions into that guild's own"""
+        config_dict = await self.config.all()
+        guild_id = config_dict['home_guild_id']
+        if not guild_id:
+            return
+        guild_config = self.config.guild_from_id(guild_id)
+        await guild_config.input_channel_ids.set(config_dict['input_channel_ids'])
+        await guild_config.output_channel_id.set(config_dict['output_channel_id'])
+        await guild_config.participant_role_id.set(config_dict['participant_role_id'])
+        await guild_config.comment_delay.set(config_dict['comment_delay'])
+        await guild_config.conversation_delay.set(config_dict['conversation_delay'])
+        path = self.guild_path(guild_id)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in (DB_FILE, f"{DB_FILE}-wal", f"{DB_FILE}-shm", SNAPSHOT_FILE):
+            if cog_data_path(self).joinpath(name).exists():
+                os.replace(cog_data_path(self).joinpath(name), path.joinpath(name))
+        for key in ('home_guild_id', 'input_channel_ids', 'output_channel_id', 'participant_role_id', 'comment_delay', 'conversation_delay'):
+            await self.config.clear_raw(key)
+        log.info(f"Moved the simulator settings and data of guild {guild_id} to their own folder")
+
+    async def setup_guild(self, simulator: GuildSimulator, settings: Optional[dict] = None) -> bool:
+        settings = settings or await self.config.guild(simulator.guild).all()
+        if not self.is_configured(settings):
+            return False
         try:
-            await self.bot.wait_until_red_ready()
-
-            # config
-            config_dict = await self.config.get_raw()
-            if not self.is_configured(config_dict):
-                self.simulator_loop.stop()
-                return False
-            guild_id = config_dict['home_guild_id']
-            input_channel_ids = config_dict['input_channel_ids']
-            output_channel_id = config_dict['output_channel_id']
-            role_id = config_dict['participant_role_id']
-            self.comment_chance = 1 / config_dict['comment_delay']
-            self.conversation_chance = 1 / config_dict['conversation_delay']
-
-            # discord entities
-            self.guild = self.bot.get_guild(guild_id)
-            if self.guild is None:
-                raise KeyError(self.guild.__name__)
-            self.role = self.guild.get_role(role_id)
-            self.input_channels = [self.guild.get_channel(i) for i in input_channel_ids]
-            self.output_channel = self.guild.get_channel(output_channel_id)
-            if self.role is None:
-                raise KeyError(self.role.__name__)
-            if any(c is None for c in self.input_channels):
-                raise KeyError(self.input_channels.__name__)
-            if self.output_channel is None:
-                raise KeyError(self.output_channel.__name__)
-            webhooks = await self.output_channel.webhooks()
-            webhooks = [w for w in webhooks if w.user == self.bot.user and w.name == WEBHOOK_NAME]
-            self.webhook = webhooks[0] if webhooks else await self.output_channel.create_webhook(name=WEBHOOK_NAME)
-
-            # database
-            async with sql.connect(cog_data_path(self).joinpath(DB_FILE)) as db:
-                await db.execute(f"CREATE TABLE IF NOT EXISTS {DB_TABLE_MESSAGES} "
-                                 f"(id INTEGER PRIMARY KEY, user_id INTEGER, content TEXT NOT NULL);")
-                await db.commit()
-                async with db.execute(f"SELECT * FROM {DB_TABLE_MESSAGES}") as cursor:
-                    async for row in cursor:
-                        self.add_message(row[1], row[2])
-            log.info(f"Simulator model built from {self.message_count} messages")
-            self.stage = Stage.READY
+            await simulator.setup(settings)
             return True
-
-        except Exception as error:  #
-            error_msg = f'Failed to set up the simulator - {type(error).__name__}: {error}'
-            log.exception("Setting up simulator")
-            self.simulator_loop.stop()
-            self.stage = Stage.NONE
-            try:
-                await self.output_channel.send(error_msg)
-            except discord.DiscordException:
-                pass
+        except Exception as error:
+            log.exception(f"Setting up simulator in guild {simulator.guild.id}")
+            if simulator.output_channel:
+                try:
+                    await simulator.output_channel.send(f'Failed to set up the simulator - {type(error).__name__}: {error}')
+                except discord.DiscordException:
+                    pass
             return False
 
-    async def feeder(self, ctx: commands.Context, days: int):
+    async def activate(self, simulator: GuildSimulator):
+        """Marks the guild as recently active, loading its model if needed and unloading others beyond the memory budget"""
+        simulator.last_active = time.monotonic()
+        if await simulator.load():
+            await self.enforce_memory_budget(keep=simulator)
+
+    async def enforce_memory_budget(self, keep: Optional[GuildSimulator] = None):
+        """Unloads the least recently active models until the rest fit in the memory budget, then prunes the biggest ones"""
+        if not self.memory_budget:
+            return
+        loaded = sorted((s for s in self.guilds.values() if s.model is not None), key=lambda s: s.last_active)
+        total = sum(simulator.memory() for simulator in loaded)
+        for simulator in loaded:
+            if total <= self.memory_budget * 2 ** 20:
+                break
+            if simulator is keep or simulator.feeding or simulator.conversation_left:
+                continue
+            total -= simulator.memory()
+            await simulator.unload()
+        for simulator in sorted(loaded, key=lambda s: s.memory(), reverse=True):
+            if total <= self.memory_budget * 2 ** 20:
+                break
+            if simulator.model is None or simulator.feeding or not simulator.model.prunable:
+                continue
+            total -= await simulator.prune(max(0, simulator.memory() - (total - self.memory_budget * 2 ** 20)))
+
+    async def feeder(self, ctx: commands.Context, simulator: GuildSimulator, status: discord.Message,
+                     checkpoints: Dict[discord.TextChannel, int], resume: bool):
         embed = discord.Embed(color=await ctx.embed_color())
         try:
-            async with sql.connect(cog_data_path(self).joinpath(DB_FILE)) as db:
-                await db.execute(f"DELETE FROM {DB_TABLE_MESSAGES}")
-                await db.commit()
-                start_date = datetime.now() - timedelta(days=days)
-                for channel in self.input_channels:
-                    async for message in channel.history(after=start_date, limit=None):
-                        if message.author.bot:
-                            continue
-                        if self.add_message(message=message):
-                            await self.insert_message_db(message, db)
-                            if self.message_count % COMMIT_SIZE == 0:
-                                await db.commit()
-                    await db.commit()
+            if not resume:
+                simulator.db.clear()
+            await HistoryFeeder(simulator, checkpoints).run(status)
         except asyncio.CancelledError:
-            self.message_count = self.message_count // COMMIT_SIZE * COMMIT_SIZE
             embed.title = "⚠ Simulator - Stopped"
-            embed.description = "Feeding has been interrupted.\n"
+            embed.description = f"Feeding has been interrupted. Use `{ctx.prefix}simulator feed resume` to continue.\n"
         except Exception as error:
             embed.title = "⚠ Simulator - Error"
-            embed.description = f"Feeding stopped due to an error.\n"
+            embed.description = f"Feeding stopped due to an error. Use `{ctx.prefix}simulator feed resume` to continue.\n"
             embed.add_field(name=type(error).__name__, value=str(error))
-            self.message_count = self.message_count // COMMIT_SIZE * COMMIT_SIZE
         else:
             embed.title = f"{EMOJI_SUCCESS} Simulator - Success"
             embed.description = "Feeding has completed and the simulator will start now.\n"
-            self.simulator_loop.start()
-            self.start_conversation()
+            simulator.running = True
+            self.start_conversation(simulator)
         finally:
-            embed.add_field(name="🧠 Model Built", value=f"Analyzed {self.message_count} messages")
+            await simulator.save_snapshot()  # every message in the model was queued for the database, so they match
+            embed.add_field(name="🧠 Model Built", value=f"Analyzed {simulator.model.message_count} messages")
             await ctx.send(embed=embed)
             try:
                 await ctx.message.remove_reaction(EMOJI_LOADING, self.bot.user)
@@ -537,38 +599,60 @@ class Simulator(commands.Cog):
 
     # Helper Functions
 
-    async def check_participant(self, ctx: commands.Context) -> bool:
-        if self.stage == Stage.NONE:
+    def guild_path(self, guild_id: int) -> Path:
+        return cog_data_path(self).joinpath(str(guild_id))
+
+    def get_simulator(self, guild: discord.Guild) -> GuildSimulator:
+        simulator = self.guilds.get(guild.id)
+        if simulator is None:
+            simulator = self.guilds[guild.id] = GuildSimulator(self, guild)
+        return simulator
+
+    async def check_participant(self, ctx: commands.Context, load: bool = True) -> Optional[GuildSimulator]:
+        """Returns the simulator of the guild with its model loaded, if the author may use it"""
+        simulator = self.guilds.get(ctx.guild.id)
+        if not simulator or simulator.stage == Stage.NONE:
             await ctx.send(f"The simulator is not set up yet. Configure it with `{ctx.prefix}simulator set`")
-            return False
-        if self.stage == Stage.SETTING_UP:
+            return None
+        if simulator.stage == Stage.SETTING_UP:
             await ctx.send(ERROR_BOOTING)
-            return False
-        if self.feeding_task and not self.feeding_task.done():
+            return None
+        if simulator.feeding:
             await ctx.send(ERROR_FEEDING)
-        if self.guild != ctx.guild:
-            await ctx.send(f"The simulator only runs in the {self.guild.name} server.")
-            return False
-        if self.role not in ctx.author.roles and not ctx.author.guild_permissions.administrator and not self.bot.is_owner(ctx.author):
-            await ctx.send(f"You must have the {self.role.name} role to participate in the simulator and view stats.")
-            return False
-        return True
+            return None
+        if simulator.role not in ctx.author.roles and not ctx.author.guild_permissions.administrator and not await self.bot.is_owner(ctx.author):
+            await ctx.send(f"You must have the {simulator.role.name} role to participate in the simulator and view stats.")
+            return None
+        if not load:
+            return simulator
+        if simulator.model is None:
+            await ctx.typing()
+        await self.activate(simulator)
+        return simulator
+
+    def start_conversation(self, simulator: GuildSimulator):
+        """Starts a conversation, loading the model in the background if needed"""
+        simulator.start_conversation()
+        simulator.last_active = time.monotonic()
+        if simulator.model is None:
+            task = asyncio.create_task(self.activate(simulator))
+            self.loading_tasks.add(task)
+            task.add_done_callback(self.loading_tasks.discard)
 
     @staticmethod
     def is_configured(config: dict) -> bool:
-        guild_id = config['home_guild_id']
         input_channel_ids = config['input_channel_ids']
         output_channel_id = config['output_channel_id']
         role_id = config['participant_role_id']
-        return guild_id != 0 and output_channel_id != 0 and role_id != 0 and input_channel_ids and 0 not in input_channel_ids
+        return output_channel_id != 0 and role_id != 0 and input_channel_ids and 0 not in input_channel_ids
 
     @staticmethod
     def is_valid_event_message(message: discord.Message) -> bool:
         return message.guild and not message.author.bot and message.type == discord.MessageType.default
 
-    def is_valid_input_message(self, message: discord.Message) -> bool:
-        return self.input_channels and message.channel in self.input_channels  \
-               and self.role and self.role in message.author.roles \
+    def is_valid_input_message(self, simulator: GuildSimulator, message: discord.Message) -> bool:
+        return simulator.input_channels and message.channel in simulator.input_channels  \
+               and simulator.role and simulator.role in message.author.roles \
                and message.author.id not in self.blacklisted_users
 
     async def is_valid_red_message(self, message: discord.Message) -> bool:
@@ -576,96 +660,8 @@ class Simulator(commands.Cog):
                and await self.bot.ignored_channel_or_guild(message) \
                and not await self.bot.cog_disabled_in_guild(self, message.guild)
 
-    @staticmethod
-    def format_message(message: discord.Message) -> str:
-        content = message.content
-        if message.attachments and message.attachments[0].url:
-            content += (' ' if content else '') + message.attachments[0].url
-        return content
-
-    @staticmethod
-    async def insert_message_db(message: discord.Message, db: sql.Connection):
-        await db.execute(f'INSERT INTO {DB_TABLE_MESSAGES} VALUES (?, ?, ?)',
-                         [message.id, message.author.id, Simulator.format_message(message)])
-
-    @staticmethod
-    async def delete_message_db(message: discord.Message, db: sql.Connection):
-        await db.execute(f'DELETE FROM {DB_TABLE_MESSAGES} WHERE id=?',
-                         [message.id])
-
-    # Simulator Functions
-
-    def add_message(self, user_id: Optional[int] = None, content: Optional[str] = None, message: Optional[discord.Message] = None) -> bool:
-        """Add a message to the model"""
-        if message:
-            user_id = message.author.id
-            content = self.format_message(message)
-        content = content.replace(CHAIN_END, '') if content else ''
-        if not content:
-            return False
-        tokens = [m.group(1) for m in TOKENIZER.finditer(content)]
-        if not tokens:
-            return False
-        for i in range(len(tokens)):  # treat special objects as 2 separate tokens, for better chains
-            subtokens = [m.group(0) for m in SUBTOKENIZER.finditer(tokens[i])]
-            if ''.join(subtokens) == tokens[i]:
-                tokens.pop(i)
-                for j in range(len(subtokens)):
-                    tokens.insert(i + j, subtokens[j])
-        tokens.append(CHAIN_END)
-        previous = ""
-        self.models.setdefault(int(user_id), UserModel(int(user_id), 0, {}))
-        user = self.models[int(user_id)]
-        user.frequency += 1
-        for token in tokens:
-            # Add token or increment its weight by 1
-            user.model.setdefault(previous, {})
-            user.model[previous][token] = user.model[previous].get(token, 0) + 1
-            previous = token
-        self.message_count += 1
-        return True
-
-    def start_conversation(self):
-        self.conversation_left = random.randrange(CONVERSATION_MIN, CONVERSATION_MAX + 1)
-
-    async def send_generated_message(self):
-        user_id, content = self.generate_message()
-        user = self.guild.get_member(int(user_id))
-        if not user or not content or user.id in self.blacklisted_users:
+    async def remove_messages(self, guild_id: Optional[int], channel_id: int, message_ids: List[int]):
+        simulator = self.guilds.get(guild_id)
+        if not simulator or simulator.stage != Stage.READY or not simulator.is_input_channel(channel_id):
             return
-        await self.webhook.send(username=user.display_name,
-                                avatar_url=user.display_avatar.url,
-                                content=content,
-                                allowed_mentions=discord.AllowedMentions.none())
-
-    def generate_message(self) -> Tuple[int, str]:
-        """Generate text based on the models"""
-        user_id, = random.choices(population=list(self.models.keys()),
-                                  weights=[x.frequency for x in self.models.values()],
-                                  k=1)
-        result = []
-        token = ""
-        previous = token
-        while token != CHAIN_END:
-            token, = random.choices(population=list(self.models[user_id].model[previous].keys()),
-                                    weights=list(self.models[user_id].model[previous].values()),
-                                    k=1)
-            result.append(token)
-            previous = token
-        result = "".join(result[:-1]).strip()
-        # formatting
-        if result.count('(') != result.count(')'):
-            result = re.sub(r"((?<=\w)[)]|[(](?=\w))", "", result)  # remove them and ignore smiley faces
-        for left, right in [('[', ']'), ('“', '”'), ('‘', '’'), ('«', '»')]:
-            if result.count(left) != result.count(right):
-                if result.count(left) > result.count(right) and not result.endswith(left):
-                    result += right
-                else:
-                    result = result.replace(left, '').replace(right, '')
-        for char in ['"', '||', '**', '__', '```', '`']:
-            if result.count(char) % 2 == 1:
-                if not result.endswith(char):
-                    result += char
-                else:
-                    result = result.replace(char, '')
-        return user_id, result
+        await simulator.delete_messages(message_ids)
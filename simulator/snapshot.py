@@ -0,0 +1,130 @@
+import os
+import sys
+import mmap
+import struct
+from array import array
+from pathlib import Path
+from typing import Optional, Tuple, List
+
+from simulator.constants import log, SNAPSHOT_VERSION
+from simulator.model import MarkovModel, UserModel
+
+# The snapshot is a header followed by flat sections of fixed-width integers, each aligned to 8 bytes,
+# so that every section can be copied straight out of a memory-mapped file:
+#   token lengths (I), token bytes, user ids (Q), user frequencies (Q), states per user (I),
+#   state keys (I), state sizes (I), and the transitions of every state (I) as stored by UserModel
+MAGIC = b"SIMM"
+HEADER = struct.Struct("<4sI8sQQQQIII")  # magic, version, byteorder, window start, last message id, last change id,
+                                         # message count, tokens, users, states
+ALIGNMENT = 8
+
+
+def _padding(length: int) -> bytes:
+    return b"\0" * (-length % ALIGNMENT)
+
+
+def serialize_snapshot(model: MarkovModel, last_message_id: int, last_change_id: int = 0, window_start: int = 0) -> List[bytes]:
+    """Converts the model into the chunks of a snapshot file. Must run on the same thread that modifies the model.
+    The model includes every message up to last_message_id sent after the window_start timestamp,
+    and every pending change up to last_change_id."""
+    tokens = [token.encode("utf-8", "surrogatepass") for token in model.vocabulary.tokens]
+    token_lengths = array('I', (len(token) for token in tokens))
+    token_bytes = b"".join(tokens)
+    users = list(model.users.values())
+    user_ids = array('Q', (user.user_id for user in users))
+    frequencies = array('Q', (user.frequency for user in users))
+    state_counts = array('I', (len(user.model) for user in users))
+    state_keys = array('I')
+    state_sizes = array('I')
+    transitions = []
+    for user in users:
+        state_keys.extend(user.model.keys())
+        for state in user.model.values():
+            state_sizes.append(len(state) // 2)
+            transitions.append(state.tobytes())
+    transition_bytes = b"".join(transitions)
+    header = HEADER.pack(MAGIC, SNAPSHOT_VERSION, sys.byteorder.encode(), window_start, last_message_id, last_change_id,
+                         model.message_count, len(tokens), len(users), len(state_keys))
+    chunks = [header]
+    for section in (token_lengths.tobytes(), token_bytes, user_ids.tobytes(), frequencies.tobytes(),
+                    state_counts.tobytes(), state_keys.tobytes(), state_sizes.tobytes(), transition_bytes):
+        chunks.append(section)
+        chunks.append(_padding(len(section)))
+    return chunks
+
+
+def write_snapshot(path: Path, chunks: List[bytes]):
+    """Atomically replaces the snapshot file"""
+    temp_path = path.with_suffix(".tmp")
+    with open(temp_path, "wb") as file:
+        file.writelines(chunks)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def load_snapshot(path: Path) -> Optional[Tuple[MarkovModel, int, int, int]]:
+    """Reads a snapshot file, returning the model, the ids of the last message and pending change included in it,
+    and the timestamp its window starts at.
+    Returns None if the snapshot is missing, outdated or corrupted."""
+    try:
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _parse_snapshot(mm)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error, UnicodeDecodeError):
+        log.exception("Reading simulator snapshot")
+        return None
+
+
+def _parse_snapshot(mm: mmap.mmap) -> Optional[Tuple[MarkovModel, int, int, int]]:
+    magic, version, byteorder, window_start, last_message_id, last_change_id, message_count, token_count, user_count, state_count = \
+        HEADER.unpack_from(mm, 0)
+    if magic != MAGIC or version != SNAPSHOT_VERSION or byteorder.rstrip(b"\0") != sys.byteorder.encode():
+        log.info("Simulator snapshot is outdated and will be rebuilt")
+        return None
+    offset = HEADER.size
+
+    def read_bytes(length: int) -> bytes:
+        nonlocal offset
+        if offset + length > len(mm):
+            raise ValueError("Simulator snapshot is truncated")
+        data = mm[offset:offset + length]
+        offset += length + (-length % ALIGNMENT)
+        return data
+
+    def read_array(typecode: str, length: int) -> array:
+        result = array(typecode)
+        result.frombytes(read_bytes(length * result.itemsize))
+        return result
+
+    token_lengths = read_array('I', token_count)
+    token_bytes = read_bytes(sum(token_lengths))
+    user_ids = read_array('Q', user_count)
+    frequencies = read_array('Q', user_count)
+    state_counts = read_array('I', user_count)
+    state_keys = read_array('I', state_count)
+    state_sizes = read_array('I', state_count)
+    transitions = read_array('I', 2 * sum(state_sizes))
+
+    model = MarkovModel()
+    vocabulary = model.vocabulary
+    vocabulary.tokens.clear()
+    vocabulary.ids.clear()
+    vocabulary.size = 0
+    position = 0
+    for length in token_lengths:
+        vocabulary.intern(token_bytes[position:position + length].decode("utf-8", "surrogatepass"))
+        position += length
+
+    state_index = 0
+    position = 0
+    for user_id, frequency, states in zip(user_ids, frequencies, state_counts):
+        user = model.users[user_id] = UserModel(user_id, frequency)
+        for key, size in zip(state_keys[state_index:state_index + states], state_sizes[state_index:state_index + states]):
+            user.model[key] = transitions[position:position + 2 * size]
+            position += 2 * size
+        state_index += states
+    model.message_count = message_count
+    model.recount()
+    return model, last_message_id, last_change_id, window_start